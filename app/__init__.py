@@ -5,6 +5,7 @@ from flask_moment import Moment
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
+from werkzeug.middleware.proxy_fix import ProxyFix
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
@@ -13,6 +14,13 @@ from config import Config
 
 app = Flask(__name__)
 app.config.from_object(Config)
+if app.config['VERIFY_BACKEND'] == 'local' and app.config['VERIFY_THROTTLE_STORE'] != 'database':
+    # Local codes depend on what the throttle store remembers; every worker
+    # process has to see the same
+    raise ValueError('VERIFY_BACKEND=local needs VERIFY_THROTTLE_STORE=database')
+if app.config['PROXY_FIX_X_FOR']:
+    # Behind a load balancer remote_addr is the balancer's; trust its X-Forwarded-For
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db, render_as_batch=True)
@@ -0,0 +1,130 @@
+"""
+Avatars served by the app itself
+
+Avatars used to be Gravatar URLs, so every row of a listing had the
+browser fetch an image from a third party, and every render hashed the
+address again. The digest is now kept in an avatar_hash column, set by
+an attribute event whenever an email changes, and /avatar/<digest>/<size>
+draws the identicon here: a 5x5 mirrored grid of cells and a colour,
+both taken from the digest.
+
+Drawn avatars are kept as files under AVATAR_CACHE_DIR. When the files
+grow past AVATAR_CACHE_BYTES the least recently served are deleted.
+Responses carry an ETag and a year-long Cache-Control, since an avatar
+never changes for a given digest and size.
+"""
+import os
+import re
+import threading
+from hashlib import md5
+from app import app
+
+# Bump when the drawing changes, so browsers drop what they cached
+VERSION = 1
+
+DIGEST = re.compile(r'^[0-9a-f]{32}$')
+
+
+def avatar_digest(email):
+    return md5(email.strip().lower().encode('utf-8')).hexdigest()
+
+
+def identicon(digest, size):
+    """SVG identicon for a hex digest, `size` pixels square"""
+    hue = int(digest[25:28], 16) * 360 // 4096
+    saturation = 45 + int(digest[28:30], 16) % 20
+    lightness = 45 + int(digest[30:32], 16) % 15
+    cells = []
+    for column in range(3):
+        for row in range(5):
+            if int(digest[column * 5 + row], 16) % 2 == 0:
+                cells.append((column, row))
+                if column < 2:
+                    cells.append((4 - column, row))
+    rects = ''.join(
+        f'<rect x="{x + 0.5}" y="{y + 0.5}" width="1" height="1"/>' for x, y in cells)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" '
+        f'viewBox="0 0 6 6" shape-rendering="crispEdges">'
+        f'<rect width="6" height="6" fill="#f0f0f0"/>'
+        f'<g fill="hsl({hue},{saturation}%,{lightness}%)">{rects}</g></svg>'
+    ).encode('utf-8')
+
+
+class AvatarCache(object):
+    """Drawn avatars on disk, at most `max_bytes` of them"""
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.used = None
+
+    def settings(self):
+        return (self.directory or app.config['AVATAR_CACHE_DIR'],
+                self.max_bytes or app.config['AVATAR_CACHE_BYTES'])
+
+    def get(self, digest, size):
+        """The SVG for digest and size, drawn if it is not on disk yet"""
+        directory, max_bytes = self.settings()
+        path = os.path.join(directory, digest[:2], f'{digest}-{size}-v{VERSION}.svg')
+        try:
+            with open(path, 'rb') as f:
+                svg = f.read()
+            # Eviction goes by modification time; mark this one as recent
+            os.utime(path)
+            return svg
+        except OSError:
+            pass
+        svg = identicon(digest, size)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            partial = f'{path}.{os.getpid()}.{threading.get_ident()}'
+            with open(partial, 'wb') as f:
+                f.write(svg)
+            os.replace(partial, path)
+        except OSError:
+            # Still served, just drawn again next time
+            app.logger.warning('Could not cache avatar %s', path, exc_info=True)
+            return svg
+        self.added(directory, max_bytes, len(svg))
+        return svg
+
+    def files(self, directory):
+        for root, dirs, names in os.walk(directory):
+            for name in names:
+                if name.endswith('.svg'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, path
+
+    def added(self, directory, max_bytes, size):
+        with self.lock:
+            if self.used is None:
+                self.used = sum(size for _, size, _ in self.files(directory))
+            else:
+                self.used += size
+            if self.used <= max_bytes:
+                return
+            # Trim to 90% so a full cache does not evict on every miss
+            for _, size, path in sorted(self.files(directory)):
+                if self.used <= max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.used -= size
+
+    def clear(self):
+        directory, _ = self.settings()
+        with self.lock:
+            for _, _, path in list(self.files(directory)):
+                os.remove(path)
+            self.used = 0
+
+
+avatar_cache = AvatarCache()
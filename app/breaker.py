@@ -0,0 +1,149 @@
+"""
+Guarding calls to external services
+
+A CircuitBreaker watches the outcome of recent calls. Once too many of
+them fail it opens and callers give up at once instead of each waiting
+out a timeout; after a pause it lets a single probe call through
+(half-open) and closes again if that succeeds. Each call is counted
+against the state it started in: a slow answer to a call made before
+the breaker opened is not taken for the probe's.
+
+A LatencyHistogram counts call durations into fixed buckets, cheap
+enough to keep for every call.
+"""
+import threading
+from bisect import bisect_left
+from collections import deque
+from time import monotonic
+from app import app
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """
+    Open once at least `failure_rate` of the last `window` calls failed
+    (and there have been `min_calls` of them); probe again after
+    `open_seconds`
+    """
+
+    def __init__(self, name, failure_rate, min_calls, window, open_seconds, clock=monotonic):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self.outcomes = deque(maxlen=window)
+        self.state = CLOSED
+        self.opened_at = None
+        self.probing = False
+        self.generation = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        A ticket for a call that may go ahead, None if it may not; report
+        the call's outcome with record(ticket, success)
+        """
+        with self.lock:
+            if self.state == OPEN and self.clock() - self.opened_at >= self.open_seconds:
+                self.change(HALF_OPEN)
+            if self.state == CLOSED:
+                return (self.generation, False)
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return (self.generation, True)
+            self.rejected += 1
+            return None
+
+    def record(self, ticket, success):
+        generation, probe = ticket
+        with self.lock:
+            if generation != self.generation:
+                # Started before the last change of state; says nothing
+                # about the service since
+                return
+            if self.state == HALF_OPEN:
+                if not probe:
+                    return
+                self.probing = False
+                if success:
+                    self.outcomes.clear()
+                    self.change(CLOSED)
+                else:
+                    self.trip()
+                return
+            self.outcomes.append(success)
+            if self.state == CLOSED and len(self.outcomes) >= self.min_calls and \
+                    self.outcomes.count(False) / len(self.outcomes) >= self.failure_rate:
+                self.trip()
+
+    def trip(self):
+        self.opened_at = self.clock()
+        self.change(OPEN)
+
+    def change(self, state):
+        if state != self.state:
+            app.logger.warning(f'Circuit breaker {self.name}: {self.state} -> {state}')
+            self.state = state
+            self.generation += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'name': self.name,
+                'state': self.state,
+                'recent_calls': len(self.outcomes),
+                'recent_failures': self.outcomes.count(False),
+                'rejected': self.rejected,
+                'opened_seconds_ago': None if self.opened_at is None
+                else round(self.clock() - self.opened_at, 1)}
+
+
+class LatencyHistogram(object):
+    """Call durations counted into buckets bounded by `bounds` (seconds)"""
+
+    bounds = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect_left(self.bounds, seconds)] += 1
+            self.total += seconds
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile call"""
+        with self.lock:
+            counts = list(self.counts)
+        rank = p / 100 * sum(counts)
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.0
+
+    def snapshot(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.total
+        calls = sum(counts)
+        labels = [f'<={bound}s' for bound in self.bounds] + [f'>{self.bounds[-1]}s']
+        return {
+            'calls': calls,
+            'mean_seconds': round(total / calls, 4) if calls else 0.0,
+            'p50_seconds': self.percentile(50),
+            'p99_seconds': self.percentile(99),
+            'buckets': dict(zip(labels, counts))}
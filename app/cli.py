@@ -1,30 +1,156 @@
+import signal
+import click
 from datetime import datetime
-from app.email import send_first_newsletter, send_second_newsletter, send_third_newsletter
+from time import sleep
+from app.newsletter import send_due_newsletters, resume_campaign
+from app.models import Campaign
+from app.mail_worker import MailWorkerPool
+from app.search import search_index
+from app.exports import exports, stream_export, filename, FORMATS
+from app.roster import RosterImport, claim_job, run_job, release_running_jobs
 
 
 def register(app):
     @app.cli.group()
-    def send_newsletter_email():
+    @click.option('--workers', type=int, help='Parallel SMTP connections')
+    @click.pass_context
+    def send_newsletter_email(ctx, workers):
         """Send email to individual clients"""
-        pass
+        ctx.meta['newsletter_workers'] = workers
 
 
     @send_newsletter_email.command()
-    def first_newsletter_command():
-        """Send first newsletter"""
-        send_first_newsletter()
-        print(str(datetime.utcnow()), 'First newsletter sent to all subscribers\n\n')
+    @click.option('--issue', type=int, help='Only send this issue of the catalog')
+    @click.option('--resume', type=int, metavar='CAMPAIGN_ID',
+                  help='Continue an interrupted campaign from its last checkpoint')
+    @click.pass_context
+    def send(ctx, issue, resume):
+        """Send each subscriber the next newsletter they are due"""
+        workers = ctx.meta.get('newsletter_workers')
+        if resume is not None:
+            run = resume_campaign(resume, workers)
+            if run is None:
+                raise click.ClickException(f'No unfinished campaign {resume}')
+            runs = [run]
+        else:
+            runs = send_due_newsletters(issue, workers)
+        for campaign, pool in runs:
+            print(str(datetime.utcnow()), f'Campaign {campaign.id}: newsletter '
+                  f'{campaign.newsletter.sequence} ({campaign.newsletter.subject}) '
+                  f'sent to {pool.sent} subscribers ({pool.rate:.1f} messages/second)')
+            for line in pool.report():
+                print('   ', line)
+            print('\n')
 
 
     @send_newsletter_email.command()
-    def second_newsletter_command():
-        """Send second newsletter"""
-        send_second_newsletter()
-        print(str(datetime.utcnow()), 'Second newsletter sent to all subscribers\n\n')
+    def campaigns():
+        """List recent campaigns and their checkpoints"""
+        for campaign in Campaign.query.order_by(Campaign.id.desc()).limit(20):
+            in_flight = campaign.deliveries.filter_by(status='claimed').count()
+            print(f'{campaign.id:>5}  newsletter {campaign.newsletter.sequence}  '
+                  f'{campaign.status:<8}  cursor {campaign.cursor}  '
+                  f'{campaign.sent} sent  {campaign.failed} failed  '
+                  f'{in_flight} unconfirmed  started {campaign.started_at}')
 
 
-    @send_newsletter_email.command()
-    def third_newsletter_command():
-        """Send thrid newsletter"""
-        send_third_newsletter()
-        print(str(datetime.utcnow()), 'Third newsletter sent to all subscribers\n\n')
+    @app.cli.command('mail-worker')
+    @click.option('--workers', default=2, show_default=True, help='Number of sending threads')
+    @click.option('--batch-size', type=int, help='Emails claimed at a time by each thread')
+    @click.option('--drain', is_flag=True, help='Exit once the outbox is empty')
+    def mail_worker(workers, batch_size, drain):
+        """Deliver queued emails from the outbox"""
+        pool = MailWorkerPool(workers=workers, batch_size=batch_size)
+        signal.signal(signal.SIGTERM, lambda signum, frame: pool.stop())
+        pool.start(drain=drain)
+        try:
+            while pool.is_alive():
+                pool.join(1)
+        except KeyboardInterrupt:
+            pool.stop()
+            pool.join()
+        print(str(datetime.utcnow()), f'Mail worker stopped: {pool.sent} sent, '
+              f'{pool.failed} failed\n\n')
+
+
+    @app.cli.group()
+    def search():
+        """User directory search index"""
+
+
+    @search.command()
+    def rebuild():
+        """Index every user afresh, after changes made around the app"""
+        indexed = search_index.rebuild()
+        print(str(datetime.utcnow()), f'Search index rebuilt: {indexed} users')
+
+
+    @app.cli.command('export')
+    @click.argument('name', type=click.Choice(sorted(exports)))
+    @click.option('--format', 'format', type=click.Choice(sorted(FORMATS)), default='csv',
+                  show_default=True)
+    @click.option('--gzip', 'compress', is_flag=True, help='Compress the file as it is written')
+    @click.option('--output', '-o', type=click.Path(dir_okay=False, allow_dash=True),
+                  help='File to write, - for stdout [default: a timestamped file here]')
+    def export(name, format, compress, output):
+        """Stream a table to a CSV or JSON lines file"""
+        output = output or filename(name, format, compress)
+        written = 0
+        with click.open_file(output, 'wb') as f:
+            for chunk in stream_export(name, format, compress):
+                f.write(chunk)
+                written += len(chunk)
+        if output != '-':
+            print(str(datetime.utcnow()), f'Exported {name} to {output} ({written} bytes)')
+
+
+    @app.cli.command('import-students')
+    @click.argument('roster', type=click.File('r', encoding='utf-8-sig'))
+    @click.option('--url', help='Address of the site, for the links in the welcome emails '
+                  '[default: SERVER_NAME]')
+    @click.option('--workers', type=int, help='Password hashing processes')
+    @click.option('--dry-run', is_flag=True, help='Check the roster without importing it')
+    def import_students(roster, url, workers, dry_run):
+        """Register every student in a CSV roster"""
+        if url is None and not app.config.get('SERVER_NAME'):
+            raise click.UsageError('Pass --url or set SERVER_NAME for the welcome email links')
+        run = RosterImport(workers=workers)
+        # The welcome emails link back to the site
+        with app.test_request_context(base_url=url):
+            imported = run.run(roster, dry_run)
+        if not imported:
+            summary = f'Roster rejected: {len(run.errors)} problems'
+        elif dry_run:
+            summary = f'Roster checked: {run.rows} students can be imported'
+        else:
+            summary = f'Imported {run.imported} students'
+        print(str(datetime.utcnow()), summary)
+        for line in run.report():
+            print('   ', line)
+        if not imported:
+            raise SystemExit(1)
+
+
+    @app.cli.command('roster-worker')
+    @click.option('--workers', type=int, help='Password hashing processes')
+    @click.option('--drain', is_flag=True, help='Exit once no roster is waiting')
+    def roster_worker(workers, drain):
+        """Import the rosters uploaded at /dashboard/import/students; run one of these"""
+        released = release_running_jobs()
+        if released:
+            print(str(datetime.utcnow()), f'{released} interrupted rosters queued again')
+        try:
+            while True:
+                job = claim_job()
+                if job is None:
+                    if drain:
+                        break
+                    sleep(app.config['ROSTER_WORKER_POLL_INTERVAL'])
+                    continue
+                run = run_job(job, workers)
+                print(str(datetime.utcnow()), f'Roster {job.id} ({job.filename}): {job.status}')
+                for line in run.report():
+                    print('   ', line)
+        except KeyboardInterrupt:
+            pass
+        print(str(datetime.utcnow()), 'Roster worker stopped\n\n')
@@ -0,0 +1,189 @@
+"""
+Parallel delivery of bulk email
+
+SMTP round trips, not CPU, limit how fast a newsletter goes out. A
+DispatchPool sends over a few threads, each with its own SMTP connection,
+while a shared token bucket keeps the whole pool within the provider's
+messages-per-second allowance.
+"""
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from smtplib import SMTPException
+from time import monotonic, perf_counter, sleep
+from app import app
+from app.email import MailBatch
+from app.breaker import LatencyHistogram
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket; acquire() blocks until a token is free"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class WorkerStats(object):
+    """What one sending thread achieved"""
+
+    def __init__(self, name):
+        self.name = name
+        self.sent = 0
+        self.failed = 0
+        # Fixed buckets: a campaign of any length keeps the same few counts
+        self.latencies = LatencyHistogram()
+
+    def summary(self, elapsed):
+        rate = self.sent / elapsed if elapsed else 0.0
+        return (f'{self.name}: {self.sent} sent, {self.failed} failed, '
+                f'{rate:.1f} messages/second, '
+                f'p50 <={self.latencies.percentile(50) * 1000:.0f}ms, '
+                f'p99 <={self.latencies.percentile(99) * 1000:.0f}ms')
+
+
+class DispatchPool(object):
+    """
+    Send messages over `workers` SMTP connections at no more than `rate`
+    messages per second in total
+
+    Used as a context manager; send() blocks until every message in the
+    call has been tried and returns the ones that failed. A send()
+    interrupted (Ctrl-C, say) cancels the messages not yet started, so
+    leaving the pool does not deliver them after all.
+    """
+
+    def __init__(self, workers=None, rate=None):
+        workers = workers or app.config['NEWSLETTER_WORKERS']
+        self.workers = max(1, min(workers, app.config['MAIL_MAX_CONNECTIONS']))
+        self.bucket = TokenBucket(
+            app.config['MAIL_RATE_LIMIT'] if rate is None else rate)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.batches = []
+        self.stats = {}
+        self.executor = None
+        self.started_at = None
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.started_at = perf_counter()
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix='newsletter')
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.executor.shutdown(cancel_futures=exc_type is not None)
+        for batch in self.batches:
+            batch.close()
+        self.elapsed = perf_counter() - self.started_at
+
+    def worker(self):
+        """This thread's SMTP connection and stats, created on first use"""
+        if not hasattr(self.local, 'batch'):
+            name = threading.current_thread().name
+            self.local.batch = MailBatch().__enter__()
+            self.local.stats = WorkerStats(name)
+            with self.lock:
+                self.batches.append(self.local.batch)
+                self.stats[name] = self.local.stats
+        return self.local.batch, self.local.stats
+
+    def deliver(self, key, msg):
+        batch, stats = self.worker()
+        self.bucket.acquire()
+        started = perf_counter()
+        try:
+            with app.app_context():
+                batch.send(msg)
+        except Exception as e:
+            # The next message on this thread starts on a fresh connection
+            batch.close()
+            stats.failed += 1
+            if isinstance(e, (SMTPException, OSError)):
+                app.logger.error(f'Email not sent to {", ".join(msg.recipients)}: {e}')
+            else:
+                app.logger.exception(f'Email not sent to {", ".join(msg.recipients)}')
+            return key
+        stats.latencies.observe(perf_counter() - started)
+        stats.sent += 1
+
+    def send(self, messages, outcome=None):
+        """
+        Send (key, message) pairs in parallel; return keys that failed
+
+        `outcome`, a dict, is filled with key: True (sent) or False as
+        messages finish. If the call is interrupted, messages not yet
+        started are cancelled, those under way are waited for, and the
+        error goes on; keys missing from `outcome` were never sent.
+        """
+        outcome = {} if outcome is None else outcome
+        futures = []
+        try:
+            for key, msg in messages:
+                futures.append((key, self.executor.submit(self.deliver, key, msg)))
+            for key, future in futures:
+                outcome[key] = self.delivered(key, future)
+        except BaseException:
+            for key, future in futures:
+                future.cancel()
+            wait([future for key, future in futures if not future.cancelled()])
+            for key, future in futures:
+                if key not in outcome and not future.cancelled():
+                    outcome[key] = self.delivered(key, future)
+            raise
+        return [key for key, future in futures if not outcome[key]]
+
+    @staticmethod
+    def delivered(key, future):
+        """Whether the delivery behind future went out"""
+        try:
+            return future.result() is None
+        except Exception as e:
+            # deliver() itself went wrong; the message cannot count as sent
+            app.logger.error(f'Delivery of {key} did not finish: {e}')
+            return False
+
+    @property
+    def sent(self):
+        return sum(stats.sent for stats in self.stats.values())
+
+    @property
+    def failed(self):
+        return sum(stats.failed for stats in self.stats.values())
+
+    @property
+    def rate(self):
+        """Messages sent per second across the pool"""
+        elapsed = self.elapsed or (perf_counter() - self.started_at)
+        return self.sent / elapsed if elapsed else 0.0
+
+    def report(self):
+        """One line per worker: throughput and tail latency"""
+        return [stats.summary(self.elapsed) for stats in self.stats.values()]
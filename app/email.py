@@ -1,15 +1,130 @@
 from flask_mail import Message
 from flask import render_template
+from smtplib import SMTPServerDisconnected, SMTPResponseException
+from time import perf_counter
 from app import mail, app, db
-from app.models import Newsletter_Subscriber
+from app.models import Outbox, User
+
+
+
+def send_email(subject, sender, recipients, text_body, html_body, connection=None, bcc=None):
+    """
+    Deliver right away over an open connection (bulk runs), otherwise
+    queue the rendered email for the mail worker
+
+    A queued email is only flushed: the caller commits it along with
+    whatever it was sent about, or rolls both back together.
+    """
+    if connection is not None:
+        connection.send(build_message(
+            subject, sender, recipients, text_body, html_body, bcc=bcc))
+        return
+    email = Outbox(
+        subject=subject,
+        sender=sender,
+        recipients=','.join(recipients),
+        bcc=','.join(bcc) if bcc else None,
+        text_body=text_body,
+        html_body=html_body)
+    db.session.add(email)
+    db.session.flush()
+
+
+def build_message(subject, sender, recipients, text_body, html_body, bcc=None):
+    msg = Message(subject, sender=sender, recipients=recipients, bcc=bcc)
+    msg.body = text_body
+    msg.html = html_body
+    return msg
 
 
+def send_fan_out_email(subject, recipients, text_body, html_body):
+    """
+    One message for many recipients
 
-def send_email(subject, sender, recipients, text_body, html_body):
-    msg = Message(subject, sender=sender, recipients=recipients)
-    msg.body = text_body
-    msg.html = html_body
-    mail.send(msg)
+    Recipients are blind-copied so they do not see each other, and only
+    a single row is queued however many there are.
+    """
+    if not recipients:
+        return
+    send_email(
+        subject,
+        sender=app.config['MAIL_DEFAULT_SENDER'],
+        recipients=[],
+        text_body=text_body,
+        html_body=html_body,
+        bcc=recipients)
+
+
+
+class MailBatch(object):
+    """
+    Keep one SMTP connection open for a whole run of emails
+
+    Flask-Mail rotates the connection after MAIL_MAX_EMAILS messages.
+    If the server drops the session (or refuses with a 421 once its own
+    per-connection limit is hit), we reconnect and retry the message.
+    """
+
+    def __init__(self, retries=1):
+        self.retries = retries
+        self.connection = None
+        self.sent = 0
+        self.failed = 0
+        self.reconnects = 0
+        self.started_at = None
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.started_at = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        self.elapsed = perf_counter() - self.started_at
+
+    def connect(self):
+        """Open the SMTP session lazily, on the first message"""
+        self.connection = mail.connect().__enter__()
+
+    def close(self):
+        """Say goodbye to the server, even if it has already hung up"""
+        if self.connection is None:
+            return
+        try:
+            self.connection.__exit__(None, None, None)
+        except (SMTPServerDisconnected, SMTPResponseException, OSError):
+            pass
+        self.connection = None
+
+    def reconnect(self):
+        self.close()
+        self.connect()
+        self.reconnects += 1
+
+    def send(self, msg):
+        """Send a message over the open connection"""
+        if self.connection is None:
+            self.connect()
+        attempt = 0
+        while True:
+            try:
+                self.connection.send(msg)
+                break
+            except (SMTPServerDisconnected, SMTPResponseException) as e:
+                dropped = isinstance(e, SMTPServerDisconnected) or e.smtp_code == 421
+                if not dropped or attempt >= self.retries:
+                    raise
+                attempt += 1
+                self.reconnect()
+        self.sent += 1
+
+    @property
+    def rate(self):
+        """Messages sent per second"""
+        elapsed = self.elapsed or (perf_counter() - self.started_at)
+        if not elapsed:
+            return 0.0
+        return self.sent / elapsed
 
 
 
@@ -124,153 +239,27 @@ def send_subscriber_private_email(email, subscriber_email, subscriber_username):
 
 
 # ==================================================
-# SAMPLE NEWSLETTERS
-# ==================================================
-
-# Newsletter 1
-
-def first_newsletter(client_email, client_username):
-    """Subscriber receives first newsletter"""
-    send_email(
-        '[somaSOMA] Why Learn To Code',
-        sender=app.config['MAIL_DEFAULT_SENDER'],
-        recipients=[client_email],
-        text_body=render_template(
-            '/emails/newsletters/week1_why_learn_to_code.txt',
-            client_email=client_email,
-            client_username=client_username),
-        html_body=render_template(
-            '/emails/newsletters/week1_why_learn_to_code.html',
-            client_email=client_email,
-            client_username=client_username))
-
-
-# Newsletter 2
-
-def second_newsletter(client_email, client_username):
-    """Subscriber receives second newsletter"""
-    send_email(
-        '[somaSOMA] Why Start With Flask',
-        sender=app.config['MAIL_DEFAULT_SENDER'],
-        recipients=[client_email],
-        text_body=render_template(
-            '/emails/newsletters/week2_why_start_with_flask.txt',
-            client_email=client_email,
-            client_username=client_username),
-        html_body=render_template(
-            '/emails/newsletters/week2_why_start_with_flask.html',
-            client_email=client_email,
-            client_username=client_username))
-
-
-# Newsletter 3
-
-def third_newsletter(client_email, client_username):
-    """Subscriber receives third newsletter"""
-    send_email(
-        '[somaSOMA] Welcome To Tailwind CSS',
-        sender=app.config['MAIL_DEFAULT_SENDER'],
-        recipients=[client_email],
-        text_body=render_template(
-            '/emails/newsletters/week3_welcome_to_tailwind_css.txt',
-            client_email=client_email,
-            client_username=client_username),
-        html_body=render_template(
-            '/emails/newsletters/week3_welcome_to_tailwind_css.html',
-            client_email=client_email,
-            client_username=client_username))
-
-# ==================================================
-# END OF SAMPLE NEWSLETTERS
-# ==================================================
-
-
-
-# ==================================================
-# SENDING NEWSLETTERS
-# ==================================================
-
-# Send first newsletter
-
-def send_first_newsletter():
-    """Send first newsletter"""
-    subscribers = Newsletter_Subscriber.query.all()
-    for subscriber in subscribers:
-        # Get subscriber details
-        subscriber_email = subscriber.email
-        subscriber_username = subscriber.email.split('@')[0].capitalize()
-        # Check if the subscriber is subscribed
-        if subscriber.subscription_status is not False:
-            # Check if the subscriber has received any newsletter before
-            if subscriber.num_newsletter == 0:
-                first_newsletter(subscriber_email, subscriber_username)
-                # Update subscriber newsletter status
-                subscriber.num_newsletter = 1
-                db.session.commit()
-
-
-# Send second newsletter
-
-def send_second_newsletter():
-    """Send second newsletter"""
-    subscribers = Newsletter_Subscriber.query.all()
-    for subscriber in subscribers:
-        # Get subscriber details
-        subscriber_email = subscriber.email
-        subscriber_username = subscriber.email.split('@')[0].capitalize()
-        # Check if the subscriber is subscribed
-        if subscriber.subscription_status is not False:
-            # Check if the subscriber has received any newsletter before
-            if subscriber.num_newsletter == 0:
-                second_newsletter(subscriber_email, subscriber_username)
-                # Update subscriber newsletter status
-                subscriber.num_newsletter = 1
-                db.session.commit()
-
-
-# Send third newsletter
-
-def send_third_newsletter():
-    """Send third newsletter"""
-    subscribers = Newsletter_Subscriber.query.all()
-    for subscriber in subscribers:
-        # Get subscriber details
-        subscriber_email = subscriber.email
-        subscriber_username = subscriber.email.split('@')[0].capitalize()
-        # Check if the subscriber is subscribed
-        if subscriber.subscription_status is not False:
-            # Check if the subscriber has received any newsletter before
-            if subscriber.num_newsletter == 0:
-                third_newsletter(subscriber_email, subscriber_username)
-                # Update subscriber newsletter status
-                subscriber.num_newsletter = 1
-                db.session.commit()
-
-
-# ==================================================
-# END OF SENDING NEWSLETTERS
+# DEACTIVATE OWN ACCOUNT
 # ==================================================
 
 
-# ==================================================
-# DEACTIVATE OWN ACCOUNT
-# ==================================================
+def admin_emails():
+    """Emails of active admins, without loading the Admin entities"""
+    return [row.email for row in db.session.query(User.email).filter(
+        User.type == 'admin', User.active == True)]
 
 
-def request_account_deletion(admin, student):
-    """Request to delete student account sent to all admins"""
-    send_email(
-        subject='[somaSOMA] Request to Deactivate Account',
-        sender=app.config['MAIL_DEFAULT_SENDER'],
-        recipients=[admin.email],
+def request_account_deletion(user):
+    """Request to delete a user's account sent to all admins in one email"""
+    send_fan_out_email(
+        '[somaSOMA] Request to Deactivate Account',
+        recipients=admin_emails(),
         text_body=render_template(
             '/emails/deactivate_account/student_email.txt',
-            admin=admin,
-            student=student),
+            student=user),
         html_body=render_template(
             '/emails/deactivate_account/student_email.html',
-            admin=admin,
-            student=student))
+            student=user))
 
 # ==================================================
 # END OF DEACTIVATE OWN ACCOUNT
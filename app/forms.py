@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired, FileAllowed
 from wtforms import StringField, SubmitField, PasswordField, BooleanField, \
     SelectField, IntegerField, TextAreaField
 from wtforms.validators import DataRequired, Length, EqualTo, Email, \
@@ -201,6 +202,31 @@ class StudentRegistrationForm(UserForm):
     submit = SubmitField('Register')
 
 
+class RosterStudentForm(StudentRegistrationForm):
+    """
+    One row of a student roster, held to the registration form's rules
+
+    Usernames and emails are checked against the database for the whole
+    roster at once, not row by row.
+    """
+    class Meta:
+        csrf = False
+
+    def validate_username(self, username):
+        pass
+
+    def validate_email(self, email):
+        pass
+
+
+class ImportStudentsForm(FlaskForm):
+    """Student roster upload"""
+    roster = FileField(
+        'Roster (CSV)',
+        validators=[FileRequired(), FileAllowed(['csv'], 'Upload a .csv file.')])
+    submit = SubmitField('Import')
+
+
 
 class AdminRegistrationForm(UserForm):
     """Admin Registration Form"""
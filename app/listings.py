@@ -0,0 +1,222 @@
+"""
+Paged listings of users
+
+The all-students, all-teachers, all-parents and all-admins pages used to
+load every row and leave paging to DataTables in the browser. They now
+fetch one page at a time from the server.
+
+Pages are found by keyset: ordered by (registered_at, id) and resumed
+after the last row shown, an index seek on ix_user_type_registered_at_id
+that costs the same on page 1 and page 20,000. DataTables asks for pages
+by offset, so table_page() seeks by keyset whenever the browser passes
+the previous page's cursor (paging forward or back through the default
+order) and only falls back to OFFSET for searches and other sort orders.
+
+A listing also names the relationships its cells show (a student's
+parent, a parent's children) and loads them with the page, a fixed
+number of statements however many rows it has.
+"""
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload, selectinload, configure_mappers
+from app import app
+from app.models import User, Student, Teacher, Parent, Admin, role_stats
+
+
+class Column(object):
+    """One column of a listing; `sort` and `search` are model attributes"""
+
+    def __init__(self, key, header, sort=None, search=False, admin_only=False):
+        self.key = key
+        self.header = header
+        self.sort = sort
+        self.search = search
+        self.admin_only = admin_only
+
+
+class Listing(object):
+    """
+    A role's listing page: its model, title and columns, and the loader
+    options for the relationships the columns show
+    """
+
+    def __init__(self, role, model, title, columns, loaders=()):
+        self.role = role
+        self.model = model
+        self.title = title
+        self.columns = columns
+        self.loaders = loaders
+
+    def visible_columns(self, user):
+        return [column for column in self.columns
+                if not column.admin_only or user.type == 'admin']
+
+    def query(self):
+        return self.model.query.filter(User.type == self.role)
+
+    def count(self):
+        return role_stats[self.role]
+
+
+def user_columns(*role_columns):
+    """The columns every listing has, around those of one role"""
+    return [
+        Column('avatar', 'Avatar'),
+        Column('name', 'Full Name', sort=User.first_name, search=True),
+        Column('username', 'Username', sort=User.username, search=True),
+        Column('email', 'Email', sort=User.email, search=True),
+        Column('phone_number', 'Phone', search=True),
+        *role_columns,
+        Column('two_factor', '2FA Status'),
+        Column('registered_at', 'Registration Date', sort=User.registered_at),
+        Column('private_email', 'Send Private Email'),
+        Column('deactivate', 'Deactivate', admin_only=True),
+        Column('delete', 'Delete', admin_only=True)
+    ]
+
+
+# Parent.parent, the children, is a backref that only exists once the
+# mappers are configured
+configure_mappers()
+
+listings = {
+    'students': Listing('student', Student, 'All Students', user_columns(
+        Column('age', 'Age', sort=Student.age),
+        Column('school', 'School', sort=Student.school, search=True),
+        Column('coding_experience', 'Coding Experience'),
+        Column('program', 'Program', sort=Student.program),
+        Column('program_schedule', 'Program Schedule'),
+        Column('cohort', 'Cohort', sort=Student.cohort),
+        Column('parent', 'Parent')),
+        # One LEFT OUTER JOIN for the parent's name, not a query per row
+        loaders=(joinedload(Student.parent).load_only(Parent.first_name, Parent.last_name),)),
+    'teachers': Listing('teacher', Teacher, 'All Teachers', user_columns(
+        Column('course', 'Course', sort=Teacher.course, search=True),
+        Column('current_residence', 'Residence', sort=Teacher.current_residence))),
+    'parents': Listing('parent', Parent, 'All Parents', user_columns(
+        Column('current_residence', 'Residence', sort=Parent.current_residence),
+        Column('children', 'Child')),
+        # Every child on the page in one SELECT ... WHERE parent_id IN (...)
+        loaders=(selectinload(Parent.parent).load_only(
+            Student.first_name, Student.last_name, Student.parent_id),)),
+    'admins': Listing('admin', Admin, 'All Admins', user_columns(
+        Column('department', 'Department', sort=Admin.department),
+        Column('current_residence', 'Residence', sort=Admin.current_residence)))
+}
+
+
+# ==============
+# Keyset paging
+# ==============
+
+def encode_cursor(user):
+    return f'{user.registered_at.isoformat()}_{user.id}'
+
+
+def decode_cursor(cursor):
+    """(registered_at, id) from a cursor; ValueError if it is not one"""
+    registered_at, _, id = cursor.rpartition('_')
+    return datetime.fromisoformat(registered_at), int(id)
+
+
+def keyset_page(query, limit, after=None, descending=False):
+    """
+    Up to `limit` rows of query in (registered_at, id) order, starting
+    after the cursor `after`; returns (rows, cursor of the last row)
+    """
+    if after is not None:
+        registered_at, id = decode_cursor(after)
+        if descending:
+            query = query.filter(or_(
+                User.registered_at < registered_at,
+                and_(User.registered_at == registered_at, User.id < id)))
+        else:
+            query = query.filter(or_(
+                User.registered_at > registered_at,
+                and_(User.registered_at == registered_at, User.id > id)))
+    if descending:
+        query = query.order_by(User.registered_at.desc(), User.id.desc())
+    else:
+        query = query.order_by(User.registered_at, User.id)
+    rows = query.limit(limit).all()
+    return rows, encode_cursor(rows[-1]) if rows else None
+
+
+def page_size(requested):
+    """Clamp a requested page size; DataTables sends -1 for 'all'"""
+    maximum = current_app.config['USERS_PAGE_MAX']
+    if requested is None:
+        return current_app.config['USERS_PAGE_SIZE']
+    if requested < 1:
+        return maximum
+    return min(requested, maximum)
+
+
+# ===========================
+# DataTables server-side API
+# ===========================
+
+def table_page(listing, args, user):
+    """
+    Answer a DataTables server-side request (draw, start, length,
+    search[value], order[0][column], order[0][dir]) for a listing
+    """
+    columns = listing.visible_columns(user)
+    start = max(args.get('start', 0, type=int), 0)
+    length = page_size(args.get('length', type=int))
+    search = args.get('search[value]', '').strip()
+    order_index = args.get('order[0][column]', type=int)
+    descending = args.get('order[0][dir]') == 'desc'
+    sort = None
+    if order_index is not None and 0 <= order_index < len(columns):
+        sort = columns[order_index].sort
+
+    query = listing.query()
+    total = filtered = listing.count()
+    if search:
+        pattern = f'%{search}%'
+        query = query.filter(or_(*[
+            attribute.ilike(pattern) for attribute in search_attributes(columns)]))
+        filtered = query.order_by(None).count()
+
+    query = query.options(*listing.loaders)
+    after = args.get('after')
+    keyset = not search and (sort is None or sort is User.registered_at)
+    if keyset and (after or start == 0):
+        rows, cursor = keyset_page(query, length, after, descending)
+    else:
+        order = User.registered_at if sort is None else sort
+        query = query.order_by(
+            order.desc() if descending else order,
+            User.id.desc() if descending else User.id)
+        rows = query.offset(start).limit(length).all()
+        # A jump in the default order lands on a page the next one can seek from
+        cursor = encode_cursor(rows[-1]) if rows and keyset else None
+    return {
+        'draw': args.get('draw', 0, type=int),
+        'recordsTotal': total,
+        'recordsFiltered': filtered,
+        'start': start,
+        'next': cursor,
+        'data': render_rows(listing, columns, rows)
+    }
+
+
+def search_attributes(columns):
+    for column in columns:
+        if column.search:
+            if column.key == 'name':
+                yield User.first_name
+                yield User.last_name
+            else:
+                yield column.sort if column.sort is not None else getattr(User, column.key)
+
+
+def render_rows(listing, columns, rows):
+    """Each row as a list of cell HTML, from the cell() macro"""
+    context = {}
+    app.update_template_context(context)
+    cell = app.jinja_env.get_template('admin/_user_cells.html').make_module(context).cell
+    return [[str(cell(column.key, row, listing.role)) for column in columns]
+            for row in rows]
@@ -0,0 +1,178 @@
+"""
+Background delivery of queued emails
+
+Routes only write rendered emails to the outbox table. A pool of worker
+threads, started with `flask mail-worker`, claims pending rows in batches,
+sends each batch over one SMTP connection and records the outcome.
+
+A failed email waits MAIL_WORKER_RETRY_DELAY seconds before its second
+try, twice that before its third, and so on. A batch that fails as a
+whole (the database is locked, say) is logged and left to its lease;
+the worker pauses, longer after each failure in a row, and carries on.
+Every MAIL_WORKER_LEASE seconds the workers also put back rows whose
+claim has expired. A sent email keeps its
+envelope for the history but not its bodies, which may carry a
+temporary password.
+"""
+import threading
+from datetime import datetime, timedelta
+from time import monotonic
+from uuid import uuid4
+from sqlalchemy import or_
+from app import app, db
+from app.models import Outbox
+from app.email import MailBatch, build_message
+
+
+def release_stale_claims(lease):
+    """Put rows claimed by a worker that died mid-batch back in the queue"""
+    expired = datetime.utcnow() - timedelta(seconds=lease)
+    released = Outbox.query.filter(
+        Outbox.status == 'sending',
+        Outbox.claimed_at < expired).update(
+            {'status': 'pending', 'claim_token': None, 'claimed_at': None},
+            synchronize_session=False)
+    db.session.commit()
+    return released
+
+
+def claim_batch(batch_size):
+    """
+    Mark up to batch_size pending emails as ours
+
+    The conditional update means two workers racing for the same rows
+    only get the ones they actually flipped from pending to sending.
+    """
+    ids = [row.id for row in db.session.query(Outbox.id).filter(
+        Outbox.status == 'pending',
+        or_(Outbox.next_attempt_at == None,
+            Outbox.next_attempt_at <= datetime.utcnow())).order_by(
+                Outbox.id).limit(batch_size)]
+    if not ids:
+        return []
+    token = uuid4().hex
+    Outbox.query.filter(
+        Outbox.id.in_(ids),
+        Outbox.status == 'pending').update(
+            {'status': 'sending', 'claim_token': token, 'claimed_at': datetime.utcnow()},
+            synchronize_session=False)
+    db.session.commit()
+    return Outbox.query.filter_by(
+        claim_token=token, status='sending').order_by(Outbox.id).all()
+
+
+def release(emails):
+    """Hand claimed but unsent emails back to the queue"""
+    for email in emails:
+        email.status = 'pending'
+        email.claim_token = None
+        email.claimed_at = None
+    db.session.commit()
+
+
+class MailWorkerPool(object):
+    """Threads that drain the outbox until asked to stop"""
+
+    def __init__(self, workers=2, batch_size=None, poll_interval=None, max_attempts=None,
+                 retry_delay=None, lease=None):
+        self.workers = workers
+        self.batch_size = batch_size or app.config['MAIL_WORKER_BATCH_SIZE']
+        self.poll_interval = poll_interval or app.config['MAIL_WORKER_POLL_INTERVAL']
+        self.max_attempts = max_attempts or app.config['MAIL_WORKER_MAX_ATTEMPTS']
+        self.retry_delay = app.config['MAIL_WORKER_RETRY_DELAY'] if retry_delay is None \
+            else retry_delay
+        self.lease = lease or app.config['MAIL_WORKER_LEASE']
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+
+    def start(self, drain=False):
+        """Start the workers; with drain=True they exit once the outbox is empty"""
+        with app.app_context():
+            release_stale_claims(self.lease)
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self.run, args=(drain,), name=f'mail-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Ask workers to finish the email in hand and return the rest"""
+        self.stop_event.set()
+
+    def join(self, timeout=None):
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def is_alive(self):
+        return any(thread.is_alive() for thread in self.threads)
+
+    def run(self, drain=False):
+        with app.app_context():
+            released_at = monotonic()
+            errors = 0
+            while not self.stop_event.is_set():
+                try:
+                    if monotonic() - released_at >= self.lease:
+                        release_stale_claims(self.lease)
+                        released_at = monotonic()
+                    emails = claim_batch(self.batch_size)
+                    if emails:
+                        self.deliver(emails)
+                except Exception:
+                    # Rows this batch claimed go back once their lease expires
+                    db.session.rollback()
+                    errors += 1
+                    app.logger.exception(f'Mail worker batch failed ({errors} in a row)')
+                    self.stop_event.wait(min(self.poll_interval * 2 ** errors, self.lease))
+                    continue
+                errors = 0
+                if not emails:
+                    if drain:
+                        break
+                    self.stop_event.wait(self.poll_interval)
+            db.session.remove()
+
+    def deliver(self, emails):
+        with MailBatch() as batch:
+            for i, email in enumerate(emails):
+                if self.stop_event.is_set():
+                    release(emails[i:])
+                    return
+                try:
+                    batch.send(build_message(
+                        email.subject,
+                        email.sender,
+                        email.get_recipients(),
+                        email.text_body,
+                        email.html_body,
+                        bcc=email.get_bcc()))
+                except Exception as e:
+                    # Start the next email on a fresh connection
+                    batch.close()
+                    self.record_failure(email, e)
+                else:
+                    email.status = 'sent'
+                    email.sent_at = datetime.utcnow()
+                    email.claim_token = None
+                    email.text_body = None
+                    email.html_body = None
+                    with self.lock:
+                        self.sent += 1
+                db.session.commit()
+
+    def record_failure(self, email, error):
+        email.attempts += 1
+        email.last_error = str(error)[:255]
+        email.claim_token = None
+        if email.attempts >= self.max_attempts:
+            email.status = 'failed'
+            with self.lock:
+                self.failed += 1
+        else:
+            email.status = 'pending'
+            email.next_attempt_at = datetime.utcnow() + timedelta(
+                seconds=self.retry_delay * 2 ** (email.attempts - 1))
+        app.logger.error(f'Outbox email {email.id} not sent: {error}')
@@ -1,15 +1,20 @@
 from app import db, login, app
+from flask import url_for
+from sqlalchemy import event
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from app.passwords import hasher
+from app.user_cache import UserCache
+from app.stats import RoleStats, EmailStats
 from datetime import datetime
+import json
 import jwt
 from time import time
-from hashlib import md5
+from app.avatars import avatar_digest
 
 
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return user_cache.load(int(id))
 
 
 # =================
@@ -18,12 +23,17 @@ def load_user(id):
 
 
 class User(db.Model, UserMixin):
+    # Listings page through one role at a time in registration order
+    __table_args__ = (
+        db.Index('ix_user_type_registered_at_id', 'type', 'registered_at', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.String(64), index=True, default='First Name')
     last_name = db.Column(db.String(64), index=True, default='Last Name')
     username = db.Column(db.String(64), index=True, unique=True, nullable=False)
     email = db.Column(db.String(128), index=True, unique=True, nullable=False)
-    password_hash = db.Column(db.String(128))
+    avatar_hash = db.Column(db.String(32))
+    password_hash = db.Column(db.String(256))
     phone_number = db.Column(db.String(20), default='+254700111222')
     verification_phone = db.Column(db.String(20))
     active = db.Column(db.Boolean, nullable=False, default=True)
@@ -46,10 +56,14 @@ class User(db.Model, UserMixin):
         return self.verification_phone is not None
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return hasher.check(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        """Stored hash predates the current PASSWORD_HASH_METHOD"""
+        return hasher.needs_rehash(self.password_hash)
 
     @property
     def is_active(self):
@@ -74,8 +88,8 @@ class User(db.Model, UserMixin):
         return User.query.get(id)
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return url_for(
+            'avatar', digest=self.avatar_hash or avatar_digest(self.email), size=size)
 
 
 
@@ -147,6 +161,9 @@ class Admin(User):
     def __repr__(self):
         return f'Admin: {self.first_name} | {self.department}'
 
+
+user_cache = UserCache(User)
+
 # =================
 # End of Application Users
 # =================
@@ -203,9 +220,27 @@ class Chapter4Quiz(db.Model):
 # Newsletter
 # =================
 
+class Newsletter(db.Model):
+    """An issue in the newsletter sequence; templates live in emails/newsletters/"""
+    id = db.Column(db.Integer, primary_key=True)
+    sequence = db.Column(db.Integer, index=True, unique=True, nullable=False)
+    subject = db.Column(db.String(128), nullable=False)
+    template = db.Column(db.String(128), nullable=False)
+
+    def __repr__(self):
+        return f'Newsletter {self.sequence}: {self.subject}'
+
+
 class Newsletter_Subscriber(db.Model):
+    # Subscribers due for an issue, in keyset order
+    __table_args__ = (
+        db.Index(
+            'ix_newsletter_subscriber_due',
+            'subscription_status', 'num_newsletter', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(128), index=True, unique=True, nullable=False)
+    avatar_hash = db.Column(db.String(32))
     num_newsletter = db.Column(db.Integer, nullable=False)
     email_confirmed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     subscription_status = db.Column(db.Boolean, nullable=False, default=True)
@@ -214,8 +249,8 @@ class Newsletter_Subscriber(db.Model):
         return f'Email: {self.email}'
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return url_for(
+            'avatar', digest=self.avatar_hash or avatar_digest(self.email), size=size)
 
     def is_active(self):
         # Override UserMixin property which always returns True
@@ -223,6 +258,58 @@ class Newsletter_Subscriber(db.Model):
         return self.subscription_status is True
 
 
+class Campaign(db.Model):
+    """One run of a newsletter issue; cursor is the last subscriber id claimed"""
+    id = db.Column(db.Integer, primary_key=True)
+    newsletter_id = db.Column(db.Integer, db.ForeignKey('newsletter.id'), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='running')
+    cursor = db.Column(db.Integer, nullable=False, default=0)
+    sent = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    finished_at = db.Column(db.DateTime)
+
+    newsletter = db.relationship('Newsletter')
+    deliveries = db.relationship(
+        'CampaignDelivery', backref='campaign', lazy='dynamic', passive_deletes=True)
+
+    def __repr__(self):
+        return f'Campaign {self.id}: newsletter {self.newsletter_id} | {self.status}'
+
+
+class CampaignDelivery(db.Model):
+    """
+    Per-recipient outcome of a campaign
+
+    'claimed' rows that never became 'sent' or 'failed' belong to a
+    chunk that was in flight when the run died.
+    """
+    __table_args__ = (db.UniqueConstraint('campaign_id', 'subscriber_id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(
+        db.Integer, db.ForeignKey('campaign.id', ondelete='CASCADE'), nullable=False)
+    subscriber_id = db.Column(
+        db.Integer, db.ForeignKey('newsletter__subscriber.id', ondelete='CASCADE'),
+        nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='claimed')
+
+    def __repr__(self):
+        return f'Delivery: campaign {self.campaign_id} to {self.subscriber_id} | {self.status}'
+
+
+role_stats = RoleStats(User, Newsletter_Subscriber)
+
+
+def set_avatar_hash(target, value, oldvalue, initiator):
+    """Keep avatar_hash in step with the address it is drawn from"""
+    target.avatar_hash = avatar_digest(value) if value else None
+
+
+event.listen(User.email, 'set', set_avatar_hash, propagate=True)
+event.listen(Newsletter_Subscriber.email, 'set', set_avatar_hash)
+
+
 # =================
 # End of newsletter
 # =================
@@ -249,6 +336,124 @@ class Email(db.Model):
         return f'Subject: {self.subject}'
 
 
+# Email history pages list one kind of email, newest first
+db.Index('ix_email_bulk_timestamp', Email.bulk, Email.timestamp.desc(), Email.id.desc())
+
+email_stats = EmailStats(Email)
+
+
 # =================
 # End of emails sent out
 # =================
+
+
+
+# =================
+# Outbox
+# =================
+
+
+class Outbox(db.Model):
+    """Rendered emails waiting to be delivered by the mail worker"""
+    __table_args__ = (db.Index('ix_outbox_status_id', 'status', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255), nullable=False)
+    sender = db.Column(db.String(128))
+    recipients = db.Column(db.Text, nullable=False)
+    bcc = db.Column(db.Text)
+    text_body = db.Column(db.Text)
+    html_body = db.Column(db.Text)
+    status = db.Column(db.String(16), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime) # a failed email waits until then
+    last_error = db.Column(db.String(255))
+    claim_token = db.Column(db.String(32), index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    claimed_at = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'Outbox: {self.subject} | {self.status}'
+
+    def get_recipients(self):
+        return [email for email in self.recipients.split(',') if email]
+
+    def get_bcc(self):
+        return [email for email in (self.bcc or '').split(',') if email]
+
+
+# =================
+# End of outbox
+# =================
+
+
+
+
+# =================
+# Roster imports
+# =================
+
+
+class RosterJob(db.Model):
+    """An uploaded student roster waiting to be imported by the roster worker"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255))
+    roster = db.Column(db.Text) # the CSV; dropped once the job is over, it holds passwords
+    base_url = db.Column(db.String(255)) # for the links in the welcome emails
+    status = db.Column(db.String(16), nullable=False, default='pending', index=True)
+    rows = db.Column(db.Integer, nullable=False, default=0)
+    hashed = db.Column(db.Integer, nullable=False, default=0) # passwords hashed so far
+    imported = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Text) # JSON [[line, message]]
+    elapsed = db.Column(db.Float) # seconds, once finished
+    admin_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'RosterJob: {self.filename} | {self.status}'
+
+    def get_errors(self):
+        return json.loads(self.errors or '[]')
+
+    @property
+    def rate(self):
+        """Rows per second: of the whole import once over, of hashing until then"""
+        if self.elapsed:
+            return self.rows / self.elapsed
+        if self.started_at is None:
+            return 0.0
+        seconds = (datetime.utcnow() - self.started_at).total_seconds()
+        return self.hashed / seconds if seconds > 0 else 0.0
+
+
+# =================
+# End of roster imports
+# =================
+
+
+
+
+# =================
+# Verification requests
+# =================
+
+
+class VerificationRequest(db.Model):
+    """A verification code sent, kept only as long as the throttle window"""
+    __table_args__ = (db.Index('ix_verification_request_key_sent', 'key', 'sent_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(160), nullable=False)
+    sent_at = db.Column(db.Float, nullable=False, index=True) # unix time
+
+    def __repr__(self):
+        return f'VerificationRequest: {self.key}'
+
+
+# =================
+# End of verification requests
+# =================
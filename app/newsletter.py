@@ -0,0 +1,278 @@
+"""
+Newsletter campaigns
+
+Issues are rows in the newsletter table (sequence, subject, template),
+so adding an issue is a data change, not new code.
+"""
+import re
+from datetime import datetime
+from itertools import islice
+from flask import render_template
+from markupsafe import escape
+from app import app, db
+from app.models import Newsletter, Newsletter_Subscriber, Campaign, CampaignDelivery
+from app.email import build_message
+from app.dispatch import DispatchPool
+
+
+# ==================================================
+# NEWSLETTERS
+# ==================================================
+
+class NewsletterRender(object):
+    """
+    Render a newsletter once per campaign, then personalise it per subscriber
+
+    The templates are rendered with markers in place of client_username
+    and client_email and split on those markers, so each subscriber costs
+    a string join instead of two Jinja renders. If a template transforms
+    the fields (e.g. with a filter) the markers no longer round-trip; we
+    notice on a sample and fall back to full renders.
+    """
+
+    fields = ('client_username', 'client_email')
+    marker = re.compile('\x00(client_username|client_email)\x00')
+
+    def __init__(self, newsletter):
+        self.newsletter = newsletter
+        self.templates = (
+            f'/emails/newsletters/{newsletter.template}.txt',
+            f'/emails/newsletters/{newsletter.template}.html')
+        markers = {field: f'\x00{field}\x00' for field in self.fields}
+        self.parts = [
+            (self.marker.split(render_template(template, **markers)),
+             app.select_jinja_autoescape(template))
+            for template in self.templates]
+        self.fallback = False
+        sample = ('Sample <&> "Subscriber"', 'sample+tag@email.com')
+        self.fallback = self.personalize(*sample) != self.render(*sample)
+
+    def render(self, client_username, client_email):
+        """Full Jinja render of both bodies"""
+        return tuple(
+            render_template(
+                template,
+                client_email=client_email,
+                client_username=client_username)
+            for template in self.templates)
+
+    def personalize(self, client_username, client_email):
+        """(text_body, html_body) for one subscriber"""
+        if self.fallback:
+            return self.render(client_username, client_email)
+        values = {'client_username': client_username, 'client_email': client_email}
+        bodies = []
+        for parts, autoescape in self.parts:
+            # re.split alternates literal text and captured field names
+            pieces = list(parts)
+            for i in range(1, len(pieces), 2):
+                value = values[pieces[i]]
+                pieces[i] = str(escape(value)) if autoescape else value
+            bodies.append(''.join(pieces))
+        return tuple(bodies)
+
+# ==================================================
+# END OF NEWSLETTERS
+# ==================================================
+
+
+
+# ==================================================
+# SENDING NEWSLETTERS
+# ==================================================
+
+# Recipients
+
+def stream_newsletter_recipients(num_newsletter, batch_size=None, after=0):
+    """
+    Yield (id, email) of active subscribers who have received
+    num_newsletter newsletters, one id-keyset page at a time, starting
+    after subscriber id `after`
+
+    Only the two columns are fetched, so nothing is held in the
+    session's identity map and memory stays flat however long the
+    list is.
+    """
+    batch_size = batch_size or app.config['NEWSLETTER_BATCH_SIZE']
+    last_id = after
+    while True:
+        page = db.session.query(
+            Newsletter_Subscriber.id, Newsletter_Subscriber.email).filter(
+                Newsletter_Subscriber.subscription_status == True,
+                Newsletter_Subscriber.num_newsletter == num_newsletter,
+                Newsletter_Subscriber.id > last_id).order_by(
+                    Newsletter_Subscriber.id).limit(batch_size).all()
+        if not page:
+            return
+        last_id = page[-1].id
+        yield from page
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists of at most size items"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def record_newsletter_progress(ids, received, sent):
+    """
+    Move subscribers from `received` to `sent` newsletters in one UPDATE;
+    the caller commits
+    """
+    if not ids:
+        return
+    Newsletter_Subscriber.query.filter(
+        Newsletter_Subscriber.id.in_(ids),
+        Newsletter_Subscriber.num_newsletter == received).update(
+            {'num_newsletter': sent}, synchronize_session=False)
+
+
+def record_deliveries(campaign_id, ids, status):
+    """Set the campaign delivery status of many subscribers in one UPDATE"""
+    if not ids:
+        return
+    CampaignDelivery.query.filter(
+        CampaignDelivery.campaign_id == campaign_id,
+        CampaignDelivery.subscriber_id.in_(ids)).update(
+            {'status': status}, synchronize_session=False)
+
+
+def claim_chunk(campaign, ids):
+    """
+    Checkpoint: log the chunk as claimed and move the cursor past it, in
+    one transaction. Progress is only recorded once a message is
+    delivered, so a run that dies here leaves the chunk due.
+    """
+    db.session.execute(CampaignDelivery.__table__.insert(), [
+        {'campaign_id': campaign.id, 'subscriber_id': id, 'status': 'claimed'}
+        for id in ids])
+    campaign.cursor = ids[-1]
+    db.session.commit()
+
+
+def settle_chunk(campaign, ids, failed, received, sequence):
+    """Record the chunk's outcome; only the delivered move on to `sequence`"""
+    failed = set(failed)
+    delivered = [id for id in ids if id not in failed]
+    record_deliveries(campaign.id, delivered, 'sent')
+    record_deliveries(campaign.id, list(failed), 'failed')
+    record_newsletter_progress(delivered, received, sequence)
+    campaign.sent += len(delivered)
+    campaign.failed += len(failed)
+    db.session.commit()
+
+
+def claimed_recipients(campaign, received):
+    """
+    (id, email) of subscribers a dead run of the campaign claimed but
+    never settled, who are still subscribed and still due the issue
+    """
+    return db.session.query(
+        Newsletter_Subscriber.id, Newsletter_Subscriber.email).join(
+            CampaignDelivery,
+            CampaignDelivery.subscriber_id == Newsletter_Subscriber.id).filter(
+                CampaignDelivery.campaign_id == campaign.id,
+                CampaignDelivery.status == 'claimed',
+                Newsletter_Subscriber.subscription_status == True,
+                Newsletter_Subscriber.num_newsletter == received).order_by(
+                    Newsletter_Subscriber.id).all()
+
+
+def send_chunk(pool, render, campaign, chunk, received, claim=True):
+    """
+    Claim, deliver and settle one chunk of (id, email) recipients;
+    claim=False for a chunk already claimed by an earlier run
+    """
+    newsletter = render.newsletter
+    ids = [subscriber.id for subscriber in chunk]
+    if claim:
+        claim_chunk(campaign, ids)
+    outcome = {}
+    try:
+        messages = []
+        for subscriber in chunk:
+            subscriber_username = subscriber.email.split('@')[0].capitalize()
+            text_body, html_body = render.personalize(
+                subscriber_username, subscriber.email)
+            messages.append((subscriber.id, build_message(
+                newsletter.subject,
+                sender=app.config['MAIL_DEFAULT_SENDER'],
+                recipients=[subscriber.email],
+                text_body=text_body,
+                html_body=html_body)))
+        failed = pool.send(messages, outcome)
+    except BaseException:
+        # Settle what is known to have been tried; the rest stays claimed,
+        # to be offered again when the campaign is resumed
+        db.session.rollback()
+        settle_chunk(campaign, [id for id in ids if id in outcome],
+                     [id for id in ids if outcome.get(id) is False],
+                     received, newsletter.sequence)
+        raise
+    settle_chunk(campaign, ids, failed, received, newsletter.sequence)
+
+
+def run_newsletter(newsletter, workers=None, campaign=None):
+    """
+    Send issue N to every active subscriber who has received N - 1
+
+    Each chunk of NEWSLETTER_PROGRESS_BATCH recipients is claimed before
+    delivery (see claim_chunk) and settled afterwards, so a campaign that
+    dies mid-run can be resumed from its cursor. Subscribers move on to
+    issue N only once their message is delivered. An interrupted run
+    settles the messages it tried and leaves the rest claimed; a resumed
+    campaign first offers those again. After a hard kill some of a
+    claimed chunk may already have gone out, but none of it is lost.
+    Returns (campaign, pool).
+    """
+    if campaign is None:
+        campaign = Campaign(newsletter=newsletter)
+        db.session.add(campaign)
+        db.session.commit()
+    received = newsletter.sequence - 1
+    render = NewsletterRender(newsletter)
+    batch_size = app.config['NEWSLETTER_PROGRESS_BATCH']
+    with DispatchPool(workers) as pool:
+        for chunk in chunked(claimed_recipients(campaign, received), batch_size):
+            send_chunk(pool, render, campaign, chunk, received, claim=False)
+        recipients = stream_newsletter_recipients(
+            num_newsletter=received, after=campaign.cursor)
+        for chunk in chunked(recipients, batch_size):
+            send_chunk(pool, render, campaign, chunk, received)
+    campaign.status = 'finished'
+    campaign.finished_at = datetime.utcnow()
+    db.session.commit()
+    return campaign, pool
+
+
+def resume_campaign(campaign_id, workers=None):
+    """
+    Continue an interrupted campaign from its last checkpoint; returns
+    None if there is no such unfinished campaign
+    """
+    campaign = db.session.get(Campaign, campaign_id)
+    if campaign is None or campaign.status == 'finished':
+        return None
+    return run_newsletter(campaign.newsletter, workers, campaign=campaign)
+
+
+def send_due_newsletters(sequence=None, workers=None):
+    """
+    Send every subscriber the next issue they are due
+
+    Issues are sent from the latest down, so a subscriber moves forward
+    by at most one issue per run. Returns (campaign, pool) pairs.
+    """
+    catalog = Newsletter.query.order_by(Newsletter.sequence.desc())
+    if sequence is not None:
+        catalog = catalog.filter_by(sequence=sequence)
+    return [run_newsletter(newsletter, workers) for newsletter in catalog.all()]
+
+
+# ==================================================
+# END OF SENDING NEWSLETTERS
+# ==================================================
@@ -0,0 +1,89 @@
+"""
+Password hashing off the request threads
+
+PBKDF2 is meant to be slow. A burst of logins used to run that many
+hashes at once, each on its request thread, and every other page waited
+for CPU behind them. Hashes now run on a small pool of threads
+(PASSWORD_HASH_WORKERS, one per core by default); hashlib releases the
+GIL while it works, so they use the cores in parallel, and a login
+beyond what the pool can take waits its turn instead of crowding out
+the rest of the site.
+
+PASSWORD_HASH_METHOD sets the algorithm and cost. Stored hashes made
+with older settings are upgraded the next time their owner logs in.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash, \
+    DEFAULT_PBKDF2_ITERATIONS
+from app import app
+
+
+class PasswordHasherBusy(Exception):
+    """Too many passwords waiting to be hashed"""
+
+
+class PasswordHasher(object):
+    """
+    Hash and check passwords on `workers` threads
+
+    At most `workers + queue_size` hashes are pending; a caller past that
+    waits up to `wait` seconds for room, then gives up with
+    PasswordHasherBusy.
+    """
+
+    def __init__(self, workers=None, queue_size=None, wait=None):
+        self.workers = workers or app.config['PASSWORD_HASH_WORKERS'] or os.cpu_count() or 1
+        self.queue_size = app.config['PASSWORD_HASH_QUEUE'] if queue_size is None \
+            else queue_size
+        self.wait = wait or app.config['PASSWORD_HASH_WAIT']
+        self.lock = threading.Lock()
+        self.slots = None
+        self.executor = None
+        self.pid = None
+
+    def pool(self):
+        """The executor for this process, started on first use"""
+        with self.lock:
+            if self.pid != os.getpid():
+                # Threads do not survive a fork; start over in the child
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='password')
+                self.slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+                self.pid = os.getpid()
+            return self.executor
+
+    def run(self, func, *args):
+        executor = self.pool()
+        if not self.slots.acquire(timeout=self.wait):
+            raise PasswordHasherBusy(f'{self.workers + self.queue_size} hashes already pending')
+        try:
+            return executor.submit(func, *args).result()
+        finally:
+            self.slots.release()
+
+    @staticmethod
+    def method():
+        """PASSWORD_HASH_METHOD as Werkzeug writes it into a hash"""
+        method = app.config['PASSWORD_HASH_METHOD']
+        if method.startswith('pbkdf2:') and method.count(':') == 1:
+            method = f'{method}:{DEFAULT_PBKDF2_ITERATIONS}'
+        return method
+
+    def hash(self, password):
+        return self.run(
+            generate_password_hash, password, self.method(),
+            app.config['PASSWORD_SALT_LENGTH'])
+
+    def check(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Whether pwhash was made with a different method, cost or salt length"""
+        method, _, rest = pwhash.partition('$')
+        salt = rest.partition('$')[0]
+        return method != self.method() or len(salt) < app.config['PASSWORD_SALT_LENGTH']
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,308 @@
+"""
+Student roster imports
+
+Schools enrol a whole class at once. Registering each student through
+the form costs two uniqueness queries, a password hash, a commit and an
+email apiece; a roster of a few hundred took minutes. A roster is now a
+CSV file, one student per row:
+
+    first_name,last_name,username,email,phone_number,password,age,school,
+    coding_experience,program,program_schedule,cohort[,parent_email]
+
+imported with `flask import-students <file>` or uploaded at
+/dashboard/import/students. The whole file is checked before anything
+is written:
+
+- every row against StudentRegistrationForm's rules
+- usernames and emails against each other and, with a few IN queries,
+  against every user already registered
+- parent_email, when given, against the registered parents
+
+One bad row rejects the file, with every problem listed by line, so a
+corrected file can simply be imported again. A good file's passwords
+are hashed on ROSTER_HASH_WORKERS processes, and its students are
+inserted ROSTER_BATCH_SIZE rows per statement into the user and student
+tables, their search entries written and their welcome emails queued
+in the outbox, all in one transaction.
+
+Hashing a few hundred passwords takes longer than a web request may,
+so the upload page only checks the file. A good roster is stored as a
+pending RosterJob, and `flask roster-worker` imports it. The job page
+shows how far it has got and how many rows a second it runs at.
+"""
+import csv
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from time import perf_counter
+from flask import render_template
+from sqlalchemy import select
+from werkzeug.datastructures import MultiDict
+from werkzeug.security import generate_password_hash
+from app import app, db
+from app.avatars import avatar_digest
+from app.forms import RosterStudentForm
+from app.models import User, Student, Outbox, RosterJob, role_stats
+from app.passwords import hasher
+from app.search import search_index
+
+COLUMNS = ('first_name', 'last_name', 'username', 'email', 'phone_number', 'password',
+           'age', 'school', 'coding_experience', 'program', 'program_schedule', 'cohort')
+OPTIONAL = ('parent_email',)
+STUDENT_COLUMNS = ('age', 'school', 'coding_experience', 'program', 'program_schedule',
+                   'cohort')
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class RosterImport(object):
+    """
+    One roster, checked and imported; read the outcome from `imported`,
+    `errors` [(line, message)] and `timings` {phase: seconds}
+
+    progress(hashed), if given, is called as the passwords are hashed.
+    """
+
+    def __init__(self, workers=None, batch_size=None, progress=None):
+        self.workers = workers or app.config['ROSTER_HASH_WORKERS'] or None
+        self.batch_size = batch_size or app.config['ROSTER_BATCH_SIZE']
+        self.progress = progress
+        self.rows = 0
+        self.imported = 0
+        self.errors = []
+        self.timings = {}
+        self.elapsed = 0.0
+
+    def run(self, lines, dry_run=False):
+        """Import the roster read from `lines` (a text file); False if it was rejected"""
+        started = perf_counter()
+        try:
+            students = self.timed('validate', self.validate, lines)
+            if self.errors or dry_run:
+                return not self.errors
+            hashes = self.timed('hash', self.hash_passwords,
+                                [student['password'] for student in students])
+            for student, password_hash in zip(students, hashes):
+                student['password_hash'] = password_hash
+            self.timed('insert', self.insert, students)
+            self.imported = len(students)
+            return True
+        finally:
+            self.elapsed = perf_counter() - started
+
+    def timed(self, phase, func, *args):
+        started = perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.timings[phase] = perf_counter() - started
+
+    @property
+    def rate(self):
+        """Rows per second, from the first line read to the commit"""
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def report(self):
+        yield f'{self.rows} rows in {self.elapsed:.2f}s ({self.rate:.0f} rows/second)'
+        yield ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in self.timings.items())
+        for line, message in self.errors:
+            yield f'line {line}: {message}'
+
+    # Checks, all made before anything is written
+
+    def validate(self, lines):
+        reader = csv.DictReader(lines)
+        missing = [name for name in COLUMNS if name not in (reader.fieldnames or ())]
+        if missing:
+            self.errors.append((1, f'missing columns: {", ".join(missing)}'))
+            return []
+        students = []
+        for row in reader:
+            self.rows += 1
+            row = {name: (row.get(name) or '').strip() for name in COLUMNS + OPTIONAL}
+            form = RosterStudentForm(
+                formdata=MultiDict(dict(row, confirm_password=row['password'])))
+            if not form.validate():
+                self.errors.extend(
+                    (reader.line_num, f'{name}: {message}')
+                    for name, messages in form.errors.items() for message in messages)
+                continue
+            row['line'] = reader.line_num
+            students.append(row)
+        self.check_unique(students, 'username')
+        self.check_unique(students, 'email')
+        self.find_parents(students)
+        self.errors.sort()
+        return students
+
+    def check_unique(self, students, name):
+        """Values of `name` repeated in the roster or already taken"""
+        column = User.__table__.c[name]
+        first = {}
+        for student in students:
+            value = student[name]
+            if value in first:
+                self.errors.append(
+                    (student['line'], f'{name}: {value} is also on line {first[value]}'))
+            else:
+                first[value] = student['line']
+        for values in chunks(list(first), self.batch_size):
+            for taken, in db.session.execute(select(column).where(column.in_(values))):
+                self.errors.append(
+                    (first[taken], f'{name}: {taken} is already registered'))
+
+    def find_parents(self, students):
+        """Set each student's parent_id from their parent_email"""
+        wanted = {student['parent_email'] for student in students
+                  if student['parent_email']}
+        user = User.__table__.c
+        parents = {}
+        for emails in chunks(list(wanted), self.batch_size):
+            parents.update(db.session.execute(
+                select(user.email, user.id).where(
+                    user.type == 'parent', user.email.in_(emails))).all())
+        for student in students:
+            email = student.pop('parent_email')
+            if email and email not in parents:
+                self.errors.append(
+                    (student['line'], f'parent_email: no parent is registered as {email}'))
+            student['parent_id'] = parents.get(email)
+
+    # Writes
+
+    def hash_passwords(self, passwords):
+        """
+        Hashes made as User.set_password makes them, spread over worker
+        processes; PBKDF2 is CPU-bound, so each core takes its share
+        """
+        hash = partial(generate_password_hash, method=hasher.method(),
+                       salt_length=app.config['PASSWORD_SALT_LENGTH'])
+        if self.workers == 1 or len(passwords) < 2:
+            return self.collect(map(hash, passwords), len(passwords))
+        workers = self.workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return self.collect(pool.map(
+                hash, passwords, chunksize=max(1, len(passwords) // (workers * 4))),
+                len(passwords))
+
+    def collect(self, hashes, total):
+        """The hashes as a list, reporting progress about a hundred times"""
+        step = max(1, total // 100)
+        collected = []
+        for password_hash in hashes:
+            collected.append(password_hash)
+            if self.progress and (len(collected) % step == 0 or len(collected) == total):
+                self.progress(len(collected))
+        return collected
+
+    def insert(self, students):
+        connection = db.session.connection()
+        user = User.__table__
+        student_table = Student.__table__
+        try:
+            for batch in chunks(students, self.batch_size):
+                connection.execute(user.insert(), [{
+                    'first_name': student['first_name'],
+                    'last_name': student['last_name'],
+                    'username': student['username'],
+                    'email': student['email'],
+                    'avatar_hash': avatar_digest(student['email']),
+                    'password_hash': student['password_hash'],
+                    'phone_number': student['phone_number'],
+                    'type': 'student'} for student in batch])
+                # executemany does not hand back the new ids everywhere;
+                # read them back by username
+                ids = dict(connection.execute(
+                    select(user.c.username, user.c.id).where(
+                        user.c.username.in_([student['username'] for student in batch]))
+                    ).all())
+                connection.execute(student_table.insert(), [
+                    dict({name: student[name] for name in STUDENT_COLUMNS},
+                         id=ids[student['username']], age=int(student['age']),
+                         parent_id=student['parent_id'])
+                    for student in batch])
+                search_index.update(connection, ids.values())
+                connection.execute(Outbox.__table__.insert(), [
+                    self.welcome_email(student) for student in batch])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        # Inserted around the ORM, so no process's totals have seen them
+        role_stats.clear(everywhere=True)
+
+    @staticmethod
+    def welcome_email(student):
+        """The outbox row send_login_details would queue for this student"""
+        return {
+            'subject': '[somaSOMA] You have been registered!',
+            'sender': app.config['MAIL_DEFAULT_SENDER'],
+            'recipients': student['email'],
+            'text_body': render_template(
+                '/emails/auth/send_login_details.txt',
+                user=student, user_password=student['password']),
+            'html_body': render_template(
+                '/emails/auth/send_login_details.html',
+                user=student, user_password=student['password'])}
+
+
+# Uploaded rosters, imported in the background
+
+
+def claim_job():
+    """The oldest pending roster, marked as running; None if there is none"""
+    job = RosterJob.query.filter_by(status='pending').order_by(RosterJob.id).first()
+    if job is None:
+        return None
+    # Conditional, so two workers cannot both take it
+    claimed = RosterJob.query.filter_by(id=job.id, status='pending').update(
+        {'status': 'running', 'started_at': datetime.utcnow()},
+        synchronize_session=False)
+    db.session.commit()
+    return db.session.get(RosterJob, job.id) if claimed else None
+
+
+def run_job(job, workers=None):
+    """Import a claimed roster and record the outcome on the job"""
+    def record_progress(hashed):
+        job.hashed = hashed
+        db.session.commit()
+
+    run = RosterImport(workers=workers, progress=record_progress)
+    # The welcome emails link back to the site the roster was uploaded to
+    with app.test_request_context(base_url=job.base_url):
+        try:
+            imported = run.run(io.StringIO(job.roster))
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception(f'Roster {job.id} ({job.filename}) not imported')
+            job.status = 'failed'
+            run.errors.append((0, f'the import stopped: {e}'))
+        else:
+            job.status = 'imported' if imported else 'rejected'
+    job.rows = run.rows
+    job.imported = run.imported
+    job.errors = json.dumps(run.errors)
+    job.elapsed = run.elapsed
+    job.finished_at = datetime.utcnow()
+    job.roster = None
+    db.session.commit()
+    return run
+
+
+def release_running_jobs():
+    """
+    Put back rosters a dead worker left running; an import commits all
+    at once, so none of them was partly imported
+    """
+    released = RosterJob.query.filter_by(status='running').update(
+        {'status': 'pending', 'hashed': 0, 'started_at': None},
+        synchronize_session=False)
+    db.session.commit()
+    return released
@@ -1,22 +1,62 @@
-from flask import render_template, redirect, url_for, flash, request, session
+import io
+from flask import render_template, redirect, url_for, flash, request, session, \
+    abort, jsonify, make_response, Response, stream_with_context
 from flask_login import current_user, login_user, logout_user, login_required
 from app.forms import ParentRegistrationForm, StudentRegistrationForm, \
     TeacherRegistrationForm, AdminRegistrationForm, LoginForm, \
     ResetPasswordForm, RequestPasswordResetForm, VerifyForm,\
     EmailForm, EditEmailForm, EditPhoneForm, EditUsernameForm, FlaskChapter2QuizForm,\
-    FlaskChapter3QuizForm, FlaskChapter4QuizForm
+    FlaskChapter3QuizForm, FlaskChapter4QuizForm, ImportStudentsForm
 from app.models import User, Parent, Student, Teacher, Admin,\
-    Newsletter_Subscriber, Email, Chapter2Quiz, Chapter3Quiz, Chapter4Quiz
+    Newsletter_Subscriber, Email, Chapter2Quiz, Chapter3Quiz, Chapter4Quiz, role_stats, \
+    email_stats, RosterJob
 from app.email import send_subscriber_private_email, send_login_details, \
     send_user_private_email
 from app.email import send_password_reset_email, thank_you_client, \
     request_account_deletion
 from werkzeug.urls import url_parse
-from app.twilio_verify_api import request_email_verification_token, \
-    check_email_verification_token
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+from app.twilio_verify_api import check_email_verification_token, verify_status
+from app.verification import dispatcher
+from app.throttle import throttle, DUPLICATE, LIMITED
+from app.passwords import PasswordHasherBusy
+from app.listings import listings, table_page, keyset_page, page_size
+from app.avatars import avatar_cache, DIGEST, VERSION
+from app.search import search_index
+from app.exports import exports, stream_export, filename, FORMATS
+from app.roster import RosterImport, COLUMNS, OPTIONAL
 from app import app, db
 
 
+@app.context_processor
+def inject_role_stats():
+    # Totals for the dashboard; counted only if a template reads one
+    return {'role_stats': role_stats}
+
+
+# Avatars
+# --------------------------------------
+
+
+@app.route('/avatar/<digest>/<int:size>')
+def avatar(digest, size):
+    """Identicon for an email digest; see app/avatars.py"""
+    if not DIGEST.match(digest) or not 1 <= size <= app.config['AVATAR_MAX_SIZE']:
+        abort(404)
+    etag = f'{digest}-{size}-v{VERSION}'
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(avatar_cache.get(digest, size))
+        response.mimetype = 'image/svg+xml'
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['AVATAR_MAX_AGE']
+    response.cache_control.immutable = True
+    return response
+
+
 
 # =========================================
 # NEWSLETTER HOME PAGE
@@ -44,11 +84,32 @@ def home():
     # Newsletter form
     if request.method == "POST":
         newsletter_client = request.form["email"]
+        decision = throttle.check(newsletter_client, request.remote_addr)
+        if decision == LIMITED:
+            flash("Too many verification codes requested. Please try again later")
+            return redirect(url_for('home'))
+        if decision == DUPLICATE:
+            # A code is already on its way to this address
+            if session.get("email") != newsletter_client:
+                session.pop("verification_dispatch", None)
+            session["email"] = newsletter_client
+            flash("Please check your email inbox for a verification code")
+            return redirect(url_for('verify_email_token'))
         # Send email owner a verification token in their inbox
-        request_email_verification_token(newsletter_client)
+        # The token is sent in the background; don't wait for it
+        ip = request.remote_addr
+        dispatch_id = dispatcher.submit(
+            newsletter_client,
+            # A code that never went out must not count against a retry
+            on_failure=lambda: throttle.forget(newsletter_client, ip))
+        if dispatch_id is None:
+            throttle.forget(newsletter_client, ip)
+            flash("We are receiving too many sign-ups right now. Please try again in a moment")
+            return redirect(url_for('home'))
         # Save user email in session
         # User not saved in database just yet
         session["email"] = newsletter_client
+        session["verification_dispatch"] = dispatch_id
         flash("Please check your email inbox for a verification code")
         # Email owner redirected to confirm token received
         return redirect(url_for('verify_email_token'))
@@ -73,6 +134,11 @@ def verify_email_token():
             return redirect(url_for("teacher_profile"))
         if current_user.type == "admin":
             return redirect(url_for("admin_profile"))
+    dispatch_status = dispatcher.status(session.get("verification_dispatch"))
+    if dispatch_status == "failed":
+        del session["verification_dispatch"]
+        flash(f"We could not send a verification code to {session['email']}. Please try again")
+        return redirect(url_for("home"))
     form = VerifyForm()
     if form.validate_on_submit():
         email = session["email"]
@@ -86,12 +152,13 @@ def verify_email_token():
             client = Newsletter_Subscriber(email=session["email"])
             client.num_newsletter = 0 # determines what newsletter to be sent
             db.session.add(client)
-            db.session.commit()
             # Remove the subscriber from the session since they are now added to the database
             del session["email"]
+            session.pop("verification_dispatch", None)
 
             # Send subscriber a thank you email
             thank_you_client(client, client_username)
+            db.session.commit()
 
             flash("Thank you for subscribing to our newsletter. Please check you inbox.")
             return redirect(url_for("home"))
@@ -99,7 +166,8 @@ def verify_email_token():
     return render_template(
         "auth/register_anonymous_user.html",
         title="Verify Your Email",
-        form=form)
+        form=form,
+        still_sending=dispatch_status == "sending")
 
 
 
@@ -178,8 +246,16 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user is None or not user.check_password(form.password.data):
-            flash("Invalid username or password")
+        try:
+            if user is None or not user.check_password(form.password.data):
+                flash("Invalid username or password")
+                return redirect(url_for("login"))
+            # Bring hashes made with older settings up to date
+            if user.password_needs_rehash():
+                user.set_password(form.password.data)
+                db.session.commit()
+        except PasswordHasherBusy:
+            flash("We are handling a lot of logins right now. Please try again in a moment")
             return redirect(url_for("login"))
         next_page = request.args.get("next")
         if not next_page or url_parse(next_page).netloc != '':
@@ -227,6 +303,7 @@ def request_password_reset():
         if user:
             # Send user an email
             send_password_reset_email(user)
+            db.session.commit()
         # Conceal database information by giving general information
         flash("Check your email for the instructions to reset your password")
         return redirect(url_for("login"))
@@ -237,6 +314,19 @@ def request_password_reset():
 
 
 
+def password_set(user, password):
+    """
+    Hash password onto user; flash a retry and return False if every
+    hashing thread is taken, so the form is shown again
+    """
+    try:
+        user.set_password(password)
+    except PasswordHasherBusy:
+        flash("We are handling a lot of requests right now. Please try again in a moment")
+        return False
+    return True
+
+
 # Reset password
 
 @app.route("/reset-password/<token>", methods=["GET", "POST"])
@@ -258,10 +348,10 @@ def reset_password(token):
         return redirect(url_for("login"))
     form = ResetPasswordForm()
     if form.validate_on_submit():
-        user.set_password(form.password.data)
-        db.session.commit()
-        flash("Your password has been reset. Login to continue")
-        return redirect(url_for("login"))
+        if password_set(user, form.password.data):
+            db.session.commit()
+            flash("Your password has been reset. Login to continue")
+            return redirect(url_for("login"))
     return render_template(
         "auth/register_anonymous_user.html",
         title="Reset Password",
@@ -293,24 +383,24 @@ def register_parent():
             phone_number=form.phone_number.data,
             current_residence=form.current_residence.data)
 
-        # Show actual student password in registration email
-        session['password'] = form.password.data
-        user_password = session['password']
+        if password_set(parent, form.password.data):
+            # Show actual student password in registration email
+            session['password'] = form.password.data
+            user_password = session['password']
 
-        # Update database
-        parent.set_password(form.password.data)
-        db.session.add(parent)
-        db.session.commit()
+            # Update database
+            db.session.add(parent)
 
-        # Send parent and email with login credentials
-        send_login_details(parent, user_password)
+            # Send parent and email with login credentials
+            send_login_details(parent, user_password)
+            db.session.commit()
 
-        # Delete student password session
-        del session['password']
+            # Delete student password session
+            del session['password']
 
-        flash(f"Successfully registered as {parent.username}! "
-              "Check your email for further guidance.")
-        return redirect(url_for('home'))
+            flash(f"Successfully registered as {parent.username}! "
+                  "Check your email for further guidance.")
+            return redirect(url_for('home'))
     return render_template(
         "auth/register_anonymous_user.html",
         title="Register As A Parent",
@@ -338,26 +428,26 @@ def register_student():
                 program=form.program.data,
                 program_schedule=form.program_schedule.data,
                 cohort=form.cohort.data,
-                parent=current_user)
+                parent_id=current_user.id)
 
-            # Show actual teacher password in registration email
-            session['password'] = form.password.data
-            user_password = session['password']
+            if password_set(student, form.password.data):
+                # Show actual teacher password in registration email
+                session['password'] = form.password.data
+                user_password = session['password']
 
-            # Update database
-            student.set_password(form.password.data)
-            db.session.add(student)
-            db.session.commit()
+                # Update database
+                db.session.add(student)
 
-            # Send student an email with login credentials
-            send_login_details(student,user_password)
+                # Send student an email with login credentials
+                send_login_details(student,user_password)
+                db.session.commit()
 
-            # Delete student password session
-            del session['password']
+                # Delete student password session
+                del session['password']
 
-            flash(f"Successfully registered your child as {student.username}! "
-                "An email has been sent to them on the next steps to take.")
-            return redirect(url_for('parent_profile'))
+                flash(f"Successfully registered your child as {student.username}! "
+                    "An email has been sent to them on the next steps to take.")
+                return redirect(url_for('parent_profile'))
     else:
         flash("You do not have access to this page!")
         if current_user.type == "student":
@@ -391,23 +481,23 @@ def register_teacher():
                 course=form.course.data,
                 current_residence=form.current_residence.data)
 
-            # Show actual teacher password in registration email
-            session['password'] = form.password.data
-            user_password = session['password']
+            if password_set(teacher, form.password.data):
+                # Show actual teacher password in registration email
+                session['password'] = form.password.data
+                user_password = session['password']
 
-            teacher.set_password(form.password.data)
-            db.session.add(teacher)
-            db.session.commit()
+                db.session.add(teacher)
 
-            # Send teacher an email with login credentials
-            send_login_details(teacher, user_password)
+                # Send teacher an email with login credentials
+                send_login_details(teacher, user_password)
+                db.session.commit()
 
-            # Delete teacher password session
-            del session['password']
+                # Delete teacher password session
+                del session['password']
 
-            flash(f"Successfully registered your teacher {teacher.username}! "
-                "An email has been sent to the teacher on the next steps.")
-            return redirect(url_for('all_teachers'))
+                flash(f"Successfully registered your teacher {teacher.username}! "
+                    "An email has been sent to the teacher on the next steps.")
+                return redirect(url_for('all_teachers'))
     else:
         flash("You do not have access to this page!")
         if current_user.type == "student":
@@ -440,24 +530,24 @@ def register_admin():
                 current_residence=form.current_residence.data,
                 department=form.department.data)
 
-            # Show actual admin password in registration email
-            session['password'] = form.password.data
-            user_password = session['password']
+            if password_set(admin, form.password.data):
+                # Show actual admin password in registration email
+                session['password'] = form.password.data
+                user_password = session['password']
 
-            # Update the database
-            admin.set_password(form.password.data)
-            db.session.add(admin)
-            db.session.commit()
+                # Update the database
+                db.session.add(admin)
 
-            # Send admin an email with login credentials
-            send_login_details(admin, user_password)
+                # Send admin an email with login credentials
+                send_login_details(admin, user_password)
+                db.session.commit()
 
-            # Delete student password session
-            del session['password']
+                # Delete student password session
+                del session['password']
 
-            flash(f"Successfully registered your teacher {admin.username}! "
-                "An email has been sent to the teacher on the next steps.")
-            return redirect(url_for('all_admins'))
+                flash(f"Successfully registered your teacher {admin.username}! "
+                    "An email has been sent to the teacher on the next steps.")
+                return redirect(url_for('all_admins'))
     else:
         flash("You do not have access to this page!")
         if current_user.type == "student":
@@ -488,6 +578,213 @@ def register_admin():
 # ==========
 
 
+# User listings
+# --------------------------------------
+
+
+def require_listing_access():
+    """Student and Parent cannot see the list of app users"""
+    if current_user.type in ('student', 'parent'):
+        abort(403)
+
+
+def render_user_listing(kind):
+    """Page of a user listing; rows come from all_users_data"""
+    require_listing_access()
+    listing = listings[kind]
+    columns = listing.visible_columns(current_user)
+    return render_template(
+        "admin/all_users.html",
+        title=listing.title,
+        kind=kind,
+        export=kind if kind in exports else None,
+        columns=columns,
+        total=listing.count(),
+        registered_at_column=[column.key for column in columns].index('registered_at'),
+        unsortable=[i for i, column in enumerate(columns) if column.sort is None]
+    )
+
+
+@app.route("/dashboard/all-<kind>/data")
+@login_required
+def all_users_data(kind):
+    """DataTables server-side processing for a user listing"""
+    require_listing_access()
+    if kind not in listings:
+        abort(404)
+    try:
+        return jsonify(table_page(listings[kind], request.args, current_user))
+    except ValueError:
+        abort(400)
+
+
+@app.route("/api/users/<kind>")
+@login_required
+def users_api(kind):
+    """Users of one role in registration order, resumed with ?after=<next>"""
+    require_listing_access()
+    if kind not in listings:
+        abort(404)
+    try:
+        users, cursor = keyset_page(
+            listings[kind].query(),
+            page_size(request.args.get('limit', type=int)),
+            request.args.get('after'))
+    except ValueError:
+        abort(400)
+    return jsonify({
+        'users': [{
+            'id': user.id,
+            'username': user.username,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'email': user.email,
+            'active': user.active,
+            'registered_at': user.registered_at.isoformat()} for user in users],
+        'next': cursor
+    })
+
+
+# User search
+# --------------------------------------
+
+
+@app.route("/dashboard/search")
+@login_required
+def search_users():
+    """Users of any role by name, username, email, school, program or cohort"""
+    # Student and Parent cannot see the list of app users
+    if current_user.type in ('student', 'parent'):
+        abort(403)
+    query = request.args.get('q', '').strip()
+    role = request.args.get('role') or None
+    if role not in (None, 'student', 'teacher', 'parent', 'admin'):
+        abort(400)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = app.config['SEARCH_RESULTS_PER_PAGE']
+    users, total = search_index.search(query, page, per_page, role)
+    next_url = url_for('search_users', q=query, role=role, page=page + 1) \
+        if page * per_page < total else None
+    prev_url = url_for('search_users', q=query, role=role, page=page - 1) \
+        if page > 1 else None
+    return render_template(
+        "admin/search_users.html",
+        title="Search Users",
+        query=query,
+        role=role,
+        users=users,
+        total=total,
+        next_url=next_url,
+        prev_url=prev_url)
+
+
+# Exports
+# --------------------------------------
+
+
+@app.route("/dashboard/export/<name>.<format>")
+@login_required
+def export(name, format):
+    """Download a table as CSV or JSON lines, gzipped with ?gzip=1"""
+    if current_user.type != 'admin':
+        abort(403)
+    if name not in exports or format not in FORMATS:
+        abort(404)
+    compress = request.args.get('gzip', 0, type=int) == 1
+    response = Response(
+        stream_with_context(stream_export(name, format, compress)),
+        mimetype='application/gzip' if compress else FORMATS[format])
+    response.headers['Content-Disposition'] = \
+        f'attachment; filename={filename(name, format, compress)}'
+    # Let proxies pass each batch on as it comes
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# Roster imports
+# --------------------------------------
+
+
+@app.route("/dashboard/import/students", methods=["GET", "POST"])
+@login_required
+def import_students():
+    """
+    Register a class of students from a CSV roster: the file is checked
+    here and imported in the background by `flask roster-worker`
+    """
+    if current_user.type != 'admin':
+        abort(403)
+    form = ImportStudentsForm()
+    run = None
+    if form.validate_on_submit():
+        run = RosterImport()
+        data = form.roster.data.read()
+        try:
+            roster = data.decode('utf-8-sig')
+        except UnicodeDecodeError as e:
+            run.errors.append((data[:e.start].count(b'\n') + 1, 'the file is not UTF-8 text'))
+        else:
+            if run.run(io.StringIO(roster, newline=''), dry_run=True):
+                job = RosterJob(
+                    filename=form.roster.data.filename, roster=roster,
+                    base_url=request.url_root, rows=run.rows, admin_id=current_user.id)
+                db.session.add(job)
+                db.session.commit()
+                flash(f"All {run.rows} students in {job.filename} passed the checks. "
+                      f"They are being imported.")
+                return redirect(url_for('roster_job', id=job.id))
+    return render_template(
+        "admin/import_students.html",
+        title="Import Students",
+        form=form,
+        run=run,
+        jobs=RosterJob.query.order_by(RosterJob.id.desc()).limit(10).all(),
+        columns=COLUMNS,
+        optional=OPTIONAL)
+
+
+@app.route("/dashboard/import/students/<int:id>")
+@login_required
+def roster_job(id):
+    """How far the import of an uploaded roster has got"""
+    if current_user.type != 'admin':
+        abort(403)
+    job = RosterJob.query.filter_by(id=id).first_or_404()
+    return render_template(
+        "admin/roster_job.html",
+        title=f"Roster {job.filename}",
+        job=job)
+
+
+# Email history
+# --------------------------------------
+
+
+def email_history(bulk, endpoint):
+    """
+    The requested page of emails filed under `bulk`, newest first, with
+    links to the newer and older pages
+    """
+    newest_first = (Email.timestamp.desc(), Email.id.desc())
+    # Page through ids alone, read from ix_email_bulk_timestamp without
+    # touching the table, then load just the emails on this page
+    emails = db.paginate(
+        select(Email.id).where(Email.bulk == bulk).order_by(*newest_first),
+        page=request.args.get('page', 1, type=int),
+        per_page=app.config['EMAILS_PER_PAGE'],
+        error_out=False,
+        count=False)
+    emails.total = email_stats[bulk]
+    emails.items = Email.query.filter(Email.id.in_(emails.items)).options(
+        # The page's authors in one query by primary key, and only what
+        # the _email*.html partials show of them
+        selectinload(Email.author).load_only(User.username, User.avatar_hash)).order_by(
+            *newest_first).all()
+    next_url = url_for(endpoint, page=emails.next_num) if emails.has_next else None
+    prev_url = url_for(endpoint, page=emails.prev_num) if emails.has_prev else None
+    return emails, next_url, prev_url
+
+
 # --------------------------------------
 # Teacher profile
 # --------------------------------------
@@ -510,10 +807,9 @@ def teacher_deactivate_account():
     # Get current user
     teacher = Teacher.query.filter_by(username=current_user.username).first()
 
-   # Send email to all admins about the request to delete account
-    admins = Admin.query.all()
-    for admin in admins:
-        request_account_deletion(admin, teacher)
+    # Send one email to all admins about the request to delete account
+    request_account_deletion(teacher)
+    db.session.commit()
 
     flash('Your request has been sent to the admins.'
           ' You will receive an email notification if approved')
@@ -546,7 +842,7 @@ def compose_direct_email_to_teacher(email):
             closing=form.closing.data,
             signature=form.signature.data,
             bulk='Teacher Email',
-            author=current_user)
+            user_id=current_user.id)
         db.session.add(email)
         db.session.commit()
         flash(f'Sample private email to {teacher_username} saved')
@@ -564,14 +860,14 @@ def compose_direct_email_to_teacher(email):
 @login_required
 def emails_to_individual_teachers():
     """Emails sent out to individual teachers"""
-    emails_sent_to_individual_teachers = Email.query.filter_by(
-        bulk='Teacher Email').all()
-    emails = len(emails_sent_to_individual_teachers)
+    emails, next_url, prev_url = email_history('Teacher Email', 'emails_to_individual_teachers')
     return render_template(
         'admin/individual_teacher_email.html',
         title='Emails Sent To Individual Teachers',
-        emails_sent_to_individual_teachers=emails_sent_to_individual_teachers,
-        emails=emails)
+        emails_sent_to_individual_teachers=emails.items,
+        emails=emails.total,
+        next_url=next_url,
+        prev_url=prev_url)
 
 
 # List of all teachers
@@ -579,14 +875,7 @@ def emails_to_individual_teachers():
 @app.route("/dashboard/all-teachers")
 @login_required
 def all_teachers():
-    teachers = Teacher.query.all()
-    all_registered_teachers = len(teachers)
-    return render_template(
-        "admin/all_teachers.html",
-        title="All Teachers",
-        teachers=teachers,
-        all_registered_teachers=all_registered_teachers
-    )
+    return render_user_listing('teachers')
 
 
 # Deactivate teacher
@@ -641,10 +930,10 @@ def send_teacher_email(id):
     # Update db so that the email is not sent again
     email.allow = True
     db.session.add(email)
-    db.session.commit()
 
     # Send email to user
     send_user_private_email(email, teacher_email, teacher_first_name)
+    db.session.commit()
 
     # Notify user that email has been sent
     flash(f'Email successfully sent to the teacher {teacher_email}')
@@ -737,7 +1026,7 @@ def compose_direct_email_to_admin(email):
             closing=form.closing.data,
             signature=form.signature.data,
             bulk='Admin Email',
-            author=current_user)
+            user_id=current_user.id)
         db.session.add(email)
         db.session.commit()
         flash(f'Sample private email to {admin_username} saved')
@@ -755,14 +1044,14 @@ def compose_direct_email_to_admin(email):
 @login_required
 def emails_to_individual_admins():
     """Emails sent out to individual admins"""
-    emails_sent_to_individual_admins = Email.query.filter_by(
-        bulk='Admin Email').all()
-    emails = len(emails_sent_to_individual_admins)
+    emails, next_url, prev_url = email_history('Admin Email', 'emails_to_individual_admins')
     return render_template(
         'admin/individual_admin_email.html',
         title='Emails Sent To Individual Admins',
-        emails_sent_to_individual_admins=emails_sent_to_individual_admins,
-        emails=emails)
+        emails_sent_to_individual_admins=emails.items,
+        emails=emails.total,
+        next_url=next_url,
+        prev_url=prev_url)
 
 
 # List all admins
@@ -770,14 +1059,7 @@ def emails_to_individual_admins():
 @app.route("/dashboard/all-admins")
 @login_required
 def all_admins():
-    admins = Admin.query.all()
-    all_registered_admins = len(admins)
-    return render_template(
-        "admin/all_admins.html",
-        title="All Admins",
-        admins=admins,
-        all_registered_admins=all_registered_admins
-    )
+    return render_user_listing('admins')
 
 
 # Deactivate admin
@@ -832,10 +1114,10 @@ def send_admin_email(id):
     # Update db so that the email is not sent again
     email.allow = True
     db.session.add(email)
-    db.session.commit()
 
     # Send email to user
     send_user_private_email(email, admin_email, admin_first_name)
+    db.session.commit()
 
     # Notify user that email has been sent
     flash(f'Email successfully sent to the teacher {admin_email}')
@@ -885,6 +1167,17 @@ def delete_admin_email(id):
     return redirect(url_for('emails_to_individual_admins'))
 
 
+# Health of the Twilio Verify API, as seen by this process
+
+@app.route('/dashboard/verify-status')
+@login_required
+def verify_api_status():
+    """Circuit breaker state and call latencies for Twilio Verify"""
+    if current_user.type != 'admin':
+        abort(403)
+    return jsonify(verify_status())
+
+
 # --------------------------------------
 # End of admin profile
 # --------------------------------------
@@ -912,12 +1205,11 @@ def parent_profile():
 @login_required
 def parent_deactivate_account():
     # Get current user
-    parent = Teacher.query.filter_by(username=current_user.username).first()
+    parent = Parent.query.filter_by(username=current_user.username).first()
 
-   # Send email to all admins about the request to delete account
-    admins = Admin.query.all()
-    for admin in admins:
-        request_account_deletion(admin, parent)
+    # Send one email to all admins about the request to delete account
+    request_account_deletion(parent)
+    db.session.commit()
 
     flash('Your request has been sent to the admins.'
           ' You will receive an email notification if approved')
@@ -950,7 +1242,7 @@ def compose_direct_email_to_parent(email):
             closing=form.closing.data,
             signature=form.signature.data,
             bulk='Parent Email',
-            author=current_user)
+            user_id=current_user.id)
         db.session.add(email)
         db.session.commit()
         flash(f'Sample private email to {parent_username} saved')
@@ -968,14 +1260,14 @@ def compose_direct_email_to_parent(email):
 @login_required
 def emails_to_individual_parents():
     """Emails sent out to individual parents"""
-    emails_sent_to_individual_parent = Email.query.filter_by(
-        bulk='Parent Email').all()
-    emails = len(emails_sent_to_individual_parent)
+    emails, next_url, prev_url = email_history('Parent Email', 'emails_to_individual_parents')
     return render_template(
         'admin/individual_parent_email.html',
         title='Emails Sent To Individual Parents',
-        emails_sent_to_individual_parent=emails_sent_to_individual_parent,
-        emails=emails)
+        emails_sent_to_individual_parent=emails.items,
+        emails=emails.total,
+        next_url=next_url,
+        prev_url=prev_url)
 
 
 # List all parents
@@ -983,14 +1275,7 @@ def emails_to_individual_parents():
 @app.route("/dashboard/all-parents")
 @login_required
 def all_parents():
-    parents = Parent.query.all()
-    all_registered_parents = len(parents)
-    return render_template(
-        "admin/all_parents.html",
-        title="All Parents",
-        parents=parents,
-        all_registered_parents=all_registered_parents
-    )
+    return render_user_listing('parents')
 
 
 # Deactivate parent
@@ -1045,10 +1330,10 @@ def send_parent_email(id):
     # Update db so that the email is not sent again
     email.allow = True
     db.session.add(email)
-    db.session.commit()
 
     # Send email to user
     send_user_private_email(email, parent_email, parent_first_name)
+    db.session.commit()
 
     # Notify user that email has been sent
     flash(f'Email successfully sent to the teacher {parent_email}')
@@ -1152,10 +1437,9 @@ def student_deactivate_account():
     # Get current user
     student = Student.query.filter_by(username=current_user.username).first()
 
-   # Send email to all admins about the request to delete account
-    admins = Admin.query.all()
-    for admin in admins:
-        request_account_deletion(admin, student)
+    # Send one email to all admins about the request to delete account
+    request_account_deletion(student)
+    db.session.commit()
 
     flash('Your request has been sent to the admins.'
           ' You will receive an email notification if approved')
@@ -1187,7 +1471,7 @@ def compose_direct_email_to_student(email):
             closing=form.closing.data,
             signature=form.signature.data,
             bulk='Student Email',
-            author=current_user)
+            user_id=current_user.id)
         db.session.add(email)
         db.session.commit()
         flash(f'Sample private email to {student_username} saved')
@@ -1205,28 +1489,21 @@ def compose_direct_email_to_student(email):
 @login_required
 def emails_to_individual_students():
     """Emails sent out to individual student"""
-    emails_sent_to_individual_student = Email.query.filter_by(
-        bulk='Student Email').all()
-    emails = len(emails_sent_to_individual_student)
+    emails, next_url, prev_url = email_history('Student Email', 'emails_to_individual_students')
     return render_template(
         'admin/individual_student_email.html',
         title='Emails Sent To Individual Students',
-        emails_sent_to_individual_student=emails_sent_to_individual_student,
-        emails=emails)
+        emails_sent_to_individual_student=emails.items,
+        emails=emails.total,
+        next_url=next_url,
+        prev_url=prev_url)
 
 
 
 @app.route("/dashboard/all-students")
 @login_required
 def all_students():
-    students = Student.query.all()
-    all_registered_students = len(students)
-    return render_template(
-        "admin/all_students.html",
-        title="All Students",
-        students=students,
-        all_registered_students=all_registered_students
-    )
+    return render_user_listing('students')
 
 
 # Deactivate student
@@ -1281,10 +1558,10 @@ def send_student_email(id):
     # Update db so that the email is not sent again
     email.allow = True
     db.session.add(email)
-    db.session.commit()
 
     # Send email to user
     send_user_private_email(email, student_email, student_first_name)
+    db.session.commit()
 
     # Notify user that email has been sent
     flash(f'Email successfully sent to the teacher {student_email}')
@@ -1349,14 +1626,14 @@ def delete_student_email(id):
 @app.route("/dashboard/bulk-emails/teachers")
 @login_required
 def bulk_emails_teachers():
-    bulk_emails_sent_to_all_teachers = Email.query.filter_by(
-        bulk='Parent Email').all()
-    emails = len(bulk_emails_sent_to_all_teachers)
+    emails, next_url, prev_url = email_history('Teacher Email', 'bulk_emails_teachers')
     return render_template(
         "admin/bulk_emails_teachers.html",
         title="Bulk Emails Sent To All Teachers",
-        bulk_emails_sent_to_all_teachers=bulk_emails_sent_to_all_teachers,
-        emails=emails
+        bulk_emails_sent_to_all_teachers=emails.items,
+        emails=emails.total,
+        next_url=next_url,
+        prev_url=prev_url
     )
 
 
@@ -1365,14 +1642,14 @@ def bulk_emails_teachers():
 @app.route("/dashboard/bulk-emails/admins")
 @login_required
 def bulk_emails_admins():
-    bulk_emails_sent_to_all_admins = Email.query.filter_by(
-        bulk='Admin Email').all()
-    emails = len(bulk_emails_sent_to_all_admins)
+    emails, next_url, prev_url = email_history('Admin Email', 'bulk_emails_admins')
     return render_template(
         "admin/bulk_emails_admins.html",
         title="Bulk Emails Sent To All Admins",
-        bulk_emails_sent_to_all_admins=bulk_emails_sent_to_all_admins,
-        emails=emails
+        bulk_emails_sent_to_all_admins=emails.items,
+        emails=emails.total,
+        next_url=next_url,
+        prev_url=prev_url
     )
 
 
@@ -1381,14 +1658,14 @@ def bulk_emails_admins():
 @app.route("/dashboard/bulk-emails/parents")
 @login_required
 def bulk_emails_parents():
-    bulk_emails_sent_to_all_parents = Email.query.filter_by(
-        bulk='Parent Email').all()
-    emails = len(bulk_emails_sent_to_all_parents)
+    emails, next_url, prev_url = email_history('Parent Email', 'bulk_emails_parents')
     return render_template(
         "admin/bulk_emails_parents.html",
         title="Bulk Emails Sent To All Parents",
-        bulk_emails_sent_to_all_parents=bulk_emails_sent_to_all_parents,
-        emails=emails
+        bulk_emails_sent_to_all_parents=emails.items,
+        emails=emails.total,
+        next_url=next_url,
+        prev_url=prev_url
     )
 
 
@@ -1397,14 +1674,14 @@ def bulk_emails_parents():
 @app.route("/dashboard/bulk-emails/students")
 @login_required
 def bulk_emails_students():
-    bulk_emails_sent_to_all_students = Email.query.filter_by(
-        bulk='Parent Email').all()
-    emails = len(bulk_emails_sent_to_all_students)
+    emails, next_url, prev_url = email_history('Student Email', 'bulk_emails_students')
     return render_template(
         "admin/bulk_emails_students.html",
         title="Bulk Emails Sent To All Students",
-        bulk_emails_sent_to_all_students=bulk_emails_sent_to_all_students,
-        emails=emails
+        bulk_emails_sent_to_all_students=emails.items,
+        emails=emails.total,
+        next_url=next_url,
+        prev_url=prev_url
     )
 
 
@@ -1424,7 +1701,7 @@ def bulk_emails_students():
 def newsletter_subscribers():
     subscribers = Newsletter_Subscriber.query.order_by(
         Newsletter_Subscriber.email_confirmed_at.desc()).all()
-    num_subscribers = len(subscribers)
+    num_subscribers = role_stats.subscribers
     return render_template(
         "admin/all_newsletter_subscribers.html",
         title="Newsletter Subscribers",
@@ -1483,7 +1760,7 @@ def newsletter_subscriber_compose_direct_email(email):
             closing=form.closing.data,
             signature=form.signature.data,
             bulk='Newsletter Subscriber',
-            author=current_user)
+            user_id=current_user.id)
         db.session.add(email)
         db.session.commit()
         flash(f'Sample private email to {subscriber_username} saved')
@@ -1510,14 +1787,14 @@ def newsletter_subscriber_compose_direct_email(email):
 @login_required
 def newsletter_subscribers_email_sent_out():
     """Emails sent out to individual newsletter subscribers"""
-    emails_sent_to_newsletter_subscribers = Email.query.filter_by(
-        bulk='Newsletter Subscriber').all()
-    emails = len(emails_sent_to_newsletter_subscribers)
+    emails, next_url, prev_url = email_history('Newsletter Subscriber', 'newsletter_subscribers_email_sent_out')
     return render_template(
         'admin/individual_newsletter_subscribers_email.html',
         title='Individual Emails Sent To Newsletter Subscribers',
-        emails_sent_to_newsletter_subscribers=emails_sent_to_newsletter_subscribers,
-        emails=emails)
+        emails_sent_to_newsletter_subscribers=emails.items,
+        emails=emails.total,
+        next_url=next_url,
+        prev_url=prev_url)
 
 
 # Send email to individual subscriber
@@ -1532,11 +1809,11 @@ def send_email(id):
     # Update db so that the email is not sent again
     email.allow = True
     db.session.add(email)
-    db.session.commit()
 
     # Send email to subscriber
     subscriber_username = session['subscriber'].split('@')[0].capitalize()
     send_subscriber_private_email(email, subscriber_email, subscriber_username)
+    db.session.commit()
 
     # Notify user that email has been sent
     flash(f'Email successfully sent to {subscriber_email}')
@@ -1631,7 +1908,7 @@ def flask_chapter2():
             question2=form.question2.data,
             question3=form.question3.data,
             question4=form.question4.data,
-            author=current_user
+            student_id=current_user.id
         )
         db.session.add(quiz)
         db.session.commit()
@@ -1675,7 +1952,7 @@ def flask_chapter3():
             question2=form.question2.data,
             question3=form.question3.data,
             question4=form.question4.data,
-            author=current_user
+            student_id=current_user.id
         )
         db.session.add(quiz)
         db.session.commit()
@@ -1718,7 +1995,7 @@ def flask_chapter4():
             question2=form.question2.data,
             question3=form.question3.data,
             question4=form.question4.data,
-            author=current_user
+            student_id=current_user.id
         )
         db.session.add(quiz)
         db.session.commit()
@@ -0,0 +1,202 @@
+"""
+User directory search
+
+Finds users of every role by name, username, email and, for students,
+school, program and cohort. The words are kept in a full-text index
+next to the user table:
+
+- SQLite: an FTS5 virtual table, ranked with bm25()
+- PostgreSQL: a table of weighted tsvectors under a GIN index, ranked
+  with ts_rank()
+
+Other databases fall back to LIKE over the same columns, unranked.
+
+The index is kept in sync by the ORM: every flush that adds, changes or
+deletes a user rewrites that user's entry in the same transaction. It is
+created with the schema (the migration, or db.create_all()). Changes
+made around the ORM, such as bulk updates or raw SQL, are only picked up
+by `flask search rebuild`.
+"""
+import re
+from sqlalchemy import bindparam, event, inspect, or_, text
+from sqlalchemy.orm import Session
+from app import app, db
+from app.models import User, Student
+
+# The columns a user is found by
+SEARCHED = {'type', 'first_name', 'last_name', 'username', 'email', 'school', 'program',
+            'cohort'}
+
+
+def terms(query):
+    """The words of a search, safe to put in either full-text syntax"""
+    return re.findall(r'\w+', query.lower())
+
+
+class FTS5(object):
+    """The index as an SQLite FTS5 table; rowid is the user id"""
+
+    create = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5("
+        "type UNINDEXED, name, username, email, details, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"]
+    drop = ["DROP TABLE IF EXISTS user_search"]
+    remove = "DELETE FROM user_search WHERE rowid IN :ids"
+    fill = (
+        "INSERT INTO user_search (rowid, type, name, username, email, details) "
+        "SELECT u.id, u.type, coalesce(u.first_name, '') || ' ' || coalesce(u.last_name, ''), "
+        "u.username, u.email, "
+        "coalesce(s.school, '') || ' ' || coalesce(s.program, '') || ' ' || coalesce(s.cohort, '') "
+        'FROM "user" u LEFT OUTER JOIN student s ON s.id = u.id {where}')
+    # Names and usernames count ten times a match in school or program
+    matches = "user_search MATCH :query"
+    rank = "bm25(user_search, 0, 10.0, 10.0, 5.0, 1.0), rowid"
+    source = "user_search"
+    id = "rowid"
+
+    @staticmethod
+    def query(words):
+        # Every word, each as a prefix: "jan"* "exam"*
+        return ' '.join(f'"{word}"*' for word in words)
+
+
+class TSVector(object):
+    """The index as a PostgreSQL tsvector table with a GIN index"""
+
+    create = [
+        'CREATE TABLE IF NOT EXISTS user_search ('
+        'id INTEGER PRIMARY KEY REFERENCES "user" (id) ON DELETE CASCADE, '
+        'type VARCHAR(64), document TSVECTOR NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS ix_user_search_document '
+        'ON user_search USING GIN (document)']
+    drop = ["DROP TABLE IF EXISTS user_search"]
+    remove = "DELETE FROM user_search WHERE id IN :ids"
+    # Punctuation becomes spaces so an address is indexed word by word,
+    # as the search terms are
+    fill = (
+        "INSERT INTO user_search (id, type, document) "
+        "SELECT u.id, u.type, "
+        "setweight(to_tsvector('simple', regexp_replace(concat_ws(' ', "
+        "u.first_name, u.last_name, u.username), '\\W+', ' ', 'g')), 'A') || "
+        "setweight(to_tsvector('simple', regexp_replace(u.email, '\\W+', ' ', 'g')), 'B') || "
+        "setweight(to_tsvector('simple', regexp_replace(concat_ws(' ', "
+        "s.school, s.program, s.cohort), '\\W+', ' ', 'g')), 'C') "
+        'FROM "user" u LEFT OUTER JOIN student s ON s.id = u.id {where} '
+        "ON CONFLICT (id) DO UPDATE SET type = excluded.type, document = excluded.document")
+    matches = "document @@ to_tsquery('simple', :query)"
+    rank = "ts_rank(document, to_tsquery('simple', :query)) DESC, id"
+    source = "user_search"
+    id = "id"
+
+    @staticmethod
+    def query(words):
+        return ' & '.join(f'{word}:*' for word in words)
+
+
+class SearchIndex(object):
+    """Full-text index of the user directory"""
+
+    backends = {'sqlite': FTS5, 'postgresql': TSVector}
+
+    def __init__(self):
+        event.listen(db.metadata, 'after_create', self.after_create)
+        event.listen(db.metadata, 'before_drop', self.before_drop)
+        event.listen(Session, 'after_flush', self.after_flush)
+
+    def backend(self, connection):
+        return self.backends.get(connection.dialect.name)
+
+    def after_create(self, target, connection, **kw):
+        self.create(connection)
+
+    def before_drop(self, target, connection, **kw):
+        backend = self.backend(connection)
+        if backend is not None:
+            for statement in backend.drop:
+                connection.execute(text(statement))
+
+    def create(self, connection):
+        backend = self.backend(connection)
+        if backend is not None:
+            for statement in backend.create:
+                connection.execute(text(statement))
+
+    def update(self, connection, ids):
+        """Rewrite the entries of these users, dropping those who are gone"""
+        backend = self.backend(connection)
+        if backend is None or not ids:
+            return
+        ids = sorted(ids)
+        connection.execute(
+            text(backend.remove).bindparams(bindparam('ids', expanding=True)), {'ids': ids})
+        connection.execute(
+            text(backend.fill.format(where='WHERE u.id IN :ids')).bindparams(
+                bindparam('ids', expanding=True)), {'ids': ids})
+
+    def rebuild(self):
+        """Index every user afresh; returns how many were indexed"""
+        connection = db.session.connection()
+        backend = self.backend(connection)
+        if backend is None:
+            return 0
+        for statement in backend.drop + backend.create:
+            connection.execute(text(statement))
+        connection.execute(text(backend.fill.format(where='')))
+        db.session.commit()
+        return db.session.query(User.id).count()
+
+    def after_flush(self, session, flush_context):
+        ids = set()
+        for obj in list(session.new) + list(session.deleted):
+            if isinstance(obj, User):
+                ids.add(obj.id)
+        for obj in session.dirty:
+            if isinstance(obj, User):
+                attrs = inspect(obj).attrs
+                if any(attrs[name].history.has_changes()
+                       for name in SEARCHED if name in attrs):
+                    ids.add(obj.id)
+        if ids:
+            self.update(session.connection(), ids)
+
+    def search(self, query, page=1, per_page=None, role=None):
+        """
+        (users, total): one page of the users matching every word of the
+        query, best matches first
+        """
+        per_page = per_page or app.config['SEARCH_RESULTS_PER_PAGE']
+        words = terms(query)
+        if not words:
+            return [], 0
+        connection = db.session.connection()
+        backend = self.backend(connection)
+        if backend is None:
+            return self.search_like(words, page, per_page, role)
+        where = backend.matches + (' AND type = :role' if role else '')
+        params = {'query': backend.query(words), 'role': role}
+        total = connection.execute(
+            text(f'SELECT count(*) FROM {backend.source} WHERE {where}'), params).scalar()
+        ids = [id for id, in connection.execute(text(
+            f'SELECT {backend.id} FROM {backend.source} WHERE {where} '
+            f'ORDER BY {backend.rank} LIMIT :limit OFFSET :offset'),
+            dict(params, limit=per_page, offset=(page - 1) * per_page))]
+        users = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+        return [users[id] for id in ids if id in users], total
+
+    def search_like(self, words, page, per_page, role):
+        query = User.query
+        for word in words:
+            pattern = f'%{word}%'
+            query = query.filter(or_(
+                User.first_name.ilike(pattern), User.last_name.ilike(pattern),
+                User.username.ilike(pattern), User.email.ilike(pattern),
+                Student.school.ilike(pattern), Student.program.ilike(pattern)))
+        if role:
+            query = query.filter(User.type == role)
+        total = query.order_by(None).count()
+        users = query.order_by(User.username).offset((page - 1) * per_page).limit(
+            per_page).all()
+        return users, total
+
+
+search_index = SearchIndex()
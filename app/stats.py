@@ -0,0 +1,189 @@
+"""
+Head counts for the dashboard
+
+The listings used to count their users with len() over every row. All
+the totals the dashboard shows (users of each role, active and inactive
+accounts, newsletter subscribers) now come from one grouped COUNT over
+the user table and one over the subscribers:
+
+    SELECT type, active, count(*) FROM user GROUP BY type, active
+
+The email history pages show how many emails of their kind are stored;
+EmailStats counts each kind over ix_email_bulk_timestamp.
+
+Answers are kept for ROLE_STATS_TTL seconds and dropped as soon as a
+transaction that adds, removes or recounts a row they cover commits
+(a new user or email, a deactivation...), so this process never shows a
+stale total and other processes catch up within the TTL.
+ROLE_STATS_TTL = 0 counts afresh every time.
+
+Writes made around the ORM (a roster import, usually run from another
+process) call clear(everywhere=True), which also touches the
+ROLE_STATS_STAMP file; every process checks its modification time
+before answering from the cache and counts afresh once it has moved.
+"""
+import os
+import threading
+from time import monotonic
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+from app import app, db
+
+
+class CachedTotals(object):
+    """
+    Counts over `models`, cached until a commit adds or deletes one of
+    their rows or changes a column in `counted`
+    """
+
+    counted = set()
+
+    def __init__(self, *models):
+        self.models = models
+        self.lock = threading.Lock()
+        self.entries = {}
+        # Bumped by clear(), so a count begun before a change is not kept
+        self.generation = 0
+        self.stamp = None
+        self.info_key = f'{type(self).__name__}_changed'
+        event.listen(Session, 'after_flush', self.after_flush)
+        event.listen(Session, 'after_commit', self.after_commit)
+        event.listen(Session, 'after_soft_rollback', self.after_soft_rollback)
+        event.listen(Session, 'after_bulk_update', self.after_bulk)
+        event.listen(Session, 'after_bulk_delete', self.after_bulk)
+
+    def cached(self, key, count):
+        """The cached answer for key, or count() if there is none fresh"""
+        ttl = app.config['ROLE_STATS_TTL']
+        stamp = self.read_stamp() if ttl else None
+        with self.lock:
+            if stamp != self.stamp:
+                # Cleared everywhere since these were counted
+                self.entries.clear()
+                self.generation += 1
+                self.stamp = stamp
+            entry = self.entries.get(key)
+            if ttl and entry is not None and entry[0] > monotonic():
+                return entry[1]
+            generation = self.generation
+        value = count()
+        if ttl:
+            with self.lock:
+                if generation == self.generation:
+                    self.entries[key] = (monotonic() + ttl, value)
+        return value
+
+    def clear(self, everywhere=False):
+        """Drop the cached totals; everywhere: in every process, not just this one"""
+        if everywhere:
+            path = app.config['ROLE_STATS_STAMP']
+            with open(path, 'a'):
+                os.utime(path)
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    @staticmethod
+    def read_stamp():
+        """When totals were last cleared everywhere, None if never"""
+        try:
+            return os.stat(app.config['ROLE_STATS_STAMP']).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    # Invalidation, on commit of a flush that changed a total
+
+    def changes_totals(self, obj, new_or_deleted):
+        if not isinstance(obj, self.models):
+            return False
+        if new_or_deleted:
+            return True
+        attrs = inspect(obj).attrs
+        return any(attrs[name].history.has_changes()
+                   for name in self.counted if name in attrs)
+
+    def after_flush(self, session, flush_context):
+        if any(self.changes_totals(obj, True)
+               for obj in list(session.new) + list(session.deleted)) or \
+                any(self.changes_totals(obj, False) for obj in session.dirty):
+            session.info[self.info_key] = True
+
+    def after_commit(self, session):
+        if session.info.pop(self.info_key, False):
+            self.clear()
+
+    def after_soft_rollback(self, session, previous_transaction):
+        session.info.pop(self.info_key, None)
+
+    def after_bulk(self, update_context):
+        if issubclass(update_context.mapper.class_, self.models):
+            self.clear()
+
+
+class RoleStats(CachedTotals):
+    """
+    Cached totals; read them as role_stats['student'], role_stats.active...
+
+    Keys are the user types ('student', 'teacher', 'parent', 'admin'),
+    'users', 'active', 'inactive', 'subscribers' (every address) and
+    'subscribed' (those still receiving the newsletter).
+    """
+
+    # Changes to other columns leave every total as it was
+    counted = {'type', 'active', 'subscription_status'}
+
+    def __init__(self, user, subscriber):
+        super().__init__(user, subscriber)
+        self.user = user.__table__
+        self.subscriber = subscriber.__table__
+
+    def counts(self):
+        """Every total, from the cache if it is fresh"""
+        return self.cached(None, self.count)
+
+    def count(self):
+        counts = dict.fromkeys(
+            ('student', 'teacher', 'parent', 'admin', 'users', 'active', 'inactive',
+             'subscribers', 'subscribed'), 0)
+        user = self.user.c
+        for type, active, number in db.session.execute(
+                select(user.type, user.active, func.count()).group_by(
+                    user.type, user.active)):
+            if type in counts:
+                counts[type] += number
+            counts['users'] += number
+            counts['active' if active else 'inactive'] += number
+        subscriber = self.subscriber.c
+        for subscribed, number in db.session.execute(
+                select(subscriber.subscription_status, func.count()).group_by(
+                    subscriber.subscription_status)):
+            counts['subscribers'] += number
+            if subscribed:
+                counts['subscribed'] += number
+        return counts
+
+    def __getitem__(self, name):
+        return self.counts()[name]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return self.counts()[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class EmailStats(CachedTotals):
+    """Cached number of stored emails of each kind: email_stats['Teacher Email']"""
+
+    counted = {'bulk'}
+
+    def __init__(self, email):
+        super().__init__(email)
+        self.email = email.__table__
+
+    def __getitem__(self, bulk):
+        return self.cached(bulk, lambda: db.session.execute(
+            select(func.count()).select_from(self.email).where(
+                self.email.c.bulk == bulk)).scalar())
@@ -0,0 +1,166 @@
+"""
+Throttling of verification code requests
+
+Subscribers press "subscribe" more than once, and every press used to
+cost an SMS or email from the Verify API. The throttle collapses repeat
+requests for the same address inside VERIFY_DEDUPE_WINDOW and caps how
+many codes an address, and an IP address, can ask for per
+VERIFY_THROTTLE_PERIOD.
+
+A request is counted when the throttle lets it through, so two at once
+cannot both slip under a cap, and forgotten again if its code is never
+sent (the dispatch queue is full, or the Verify API fails); a retry is
+then not taken for a duplicate of a code that does not exist.
+
+Sends are remembered in a store. The default keeps them in memory,
+per process, in bounded space; VERIFY_THROTTLE_STORE = 'database' shares
+them between gunicorn workers through the verification_request table.
+"""
+import threading
+from collections import OrderedDict, deque
+from time import time
+from app import app, db
+from app.models import VerificationRequest
+
+
+SEND = 'send'
+DUPLICATE = 'duplicate'
+LIMITED = 'limited'
+
+
+class MemoryThrottleStore(object):
+    """
+    Recent send times per key, for at most `max_keys` keys
+
+    Each key keeps only its `depth` latest times, which is all the
+    throttle ever looks at; the least recently used key is dropped
+    once the store is full.
+    """
+
+    def __init__(self, max_keys, depth):
+        self.max_keys = max_keys
+        self.depth = depth
+        self.entries = OrderedDict()
+
+    def recent(self, key, since):
+        """Send times for key no older than `since`, oldest first"""
+        times = self.entries.get(key)
+        if times is None:
+            return []
+        while times and times[0] < since:
+            times.popleft()
+        if not times:
+            del self.entries[key]
+            return []
+        self.entries.move_to_end(key)
+        return list(times)
+
+    def add(self, key, at):
+        times = self.entries.get(key)
+        if times is None:
+            times = self.entries[key] = deque(maxlen=self.depth)
+        times.append(at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_keys:
+            self.entries.popitem(last=False)
+
+    def forget(self, key):
+        """Drop the latest send time for key"""
+        times = self.entries.get(key)
+        if times:
+            times.pop()
+            if not times:
+                del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+
+class DatabaseThrottleStore(object):
+    """Send times in the verification_request table, shared by all processes"""
+
+    def recent(self, key, since):
+        # Rows outside the window are no use to anyone; drop them as we go
+        VerificationRequest.query.filter(
+            VerificationRequest.sent_at < since).delete(synchronize_session=False)
+        db.session.commit()
+        return [row.sent_at for row in db.session.query(VerificationRequest.sent_at).filter(
+            VerificationRequest.key == key,
+            VerificationRequest.sent_at >= since).order_by(VerificationRequest.sent_at)]
+
+    def add(self, key, at):
+        db.session.add(VerificationRequest(key=key, sent_at=at))
+        db.session.commit()
+
+    def forget(self, key):
+        """Drop the latest send time for key"""
+        latest = VerificationRequest.query.filter_by(key=key).order_by(
+            VerificationRequest.sent_at.desc(), VerificationRequest.id.desc()).first()
+        if latest is not None:
+            db.session.delete(latest)
+            db.session.commit()
+
+    def clear(self):
+        VerificationRequest.query.delete()
+        db.session.commit()
+
+
+class VerificationThrottle(object):
+    """Decide whether a verification code request should go out"""
+
+    def __init__(self, store=None):
+        self.store = store
+        self.lock = threading.Lock()
+
+    def get_store(self):
+        if self.store is None:
+            if app.config['VERIFY_THROTTLE_STORE'] == 'database':
+                self.store = DatabaseThrottleStore()
+            else:
+                self.store = MemoryThrottleStore(
+                    app.config['VERIFY_THROTTLE_MAX_KEYS'],
+                    max(app.config['VERIFY_MAX_PER_ADDRESS'], app.config['VERIFY_MAX_PER_IP'],
+                        app.config['VERIFY_MAX_CHECK_FAILURES']))
+        return self.store
+
+    @staticmethod
+    def keys(address, ip):
+        return f'address:{address.strip().lower()}', f'ip:{ip}'
+
+    def check(self, address, ip, now=None):
+        """
+        SEND (and remember it), DUPLICATE if a code went to this address
+        moments ago, or LIMITED if the address or IP is over its cap
+        """
+        now = time() if now is None else now
+        since = now - app.config['VERIFY_THROTTLE_PERIOD']
+        address_key, ip_key = self.keys(address, ip)
+        # Atomic within this process; across processes the database
+        # store may let a simultaneous request or two through
+        with self.lock:
+            store = self.get_store()
+            sent = store.recent(address_key, since)
+            if sent and now - sent[-1] < app.config['VERIFY_DEDUPE_WINDOW']:
+                return DUPLICATE
+            if len(sent) >= app.config['VERIFY_MAX_PER_ADDRESS']:
+                return LIMITED
+            if len(store.recent(ip_key, since)) >= app.config['VERIFY_MAX_PER_IP']:
+                return LIMITED
+            store.add(address_key, now)
+            store.add(ip_key, now)
+            return SEND
+
+    def forget(self, address, ip):
+        """Uncount the latest SEND for address and ip: its code never went out"""
+        with self.lock:
+            store = self.get_store()
+            for key in self.keys(address, ip):
+                store.forget(key)
+
+    def reset(self):
+        """Forget every send"""
+        with self.lock:
+            self.get_store().clear()
+
+
+throttle = VerificationThrottle()
@@ -1,15 +1,274 @@
-from flask import current_app
+import hashlib
+import hmac
+import os
+import threading
+from abc import ABC, abstractmethod
+from time import time, perf_counter
+from flask import current_app, render_template
+from requests import RequestException
+from requests.adapters import HTTPAdapter
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
 from twilio.rest import Client, TwilioException
+from app import app, db
+from app.breaker import CircuitBreaker, LatencyHistogram
+from app.email import send_email
+from app.throttle import throttle
+
+
+_client_lock = threading.Lock()
+_client = None
+
+
+def _build_twilio_verify_client(config):
+    """A Verify service client on a pooled, keep-alive HTTP session"""
+    http_client = TwilioHttpClient()
+    # requests takes (connect, read); the constructor only accepts one number
+    http_client.timeout = (config['TWILIO_CONNECT_TIMEOUT'], config['TWILIO_READ_TIMEOUT'])
+    adapter = HTTPAdapter(pool_maxsize=config['TWILIO_HTTP_POOL_SIZE'])
+    http_client.session.mount('https://', adapter)
+    http_client.session.mount('http://', adapter)
+    client = Client(
+        config['TWILIO_ACCOUNT_SID'],
+        config['TWILIO_AUTH_TOKEN'],
+        http_client=http_client)
+    if config['TWILIO_VERIFY_BASE_URL']:
+        client.verify.base_url = config['TWILIO_VERIFY_BASE_URL']
+    return client.verify.services(config['TWILIO_VERIFY_SERVICE_ID'])
 
 
 def _get_twilio_verify_client():
     """
     Get the Twilio Verify API client
+
+    Built once per process and shared by all threads, so only the first
+    verification pays for client construction and the TLS handshake.
+    A forked worker (e.g. gunicorn) sees a different pid and builds its
+    own instead of sharing the parent's sockets.
+    """
+    global _client
+    config = current_app.config
+    key = (
+        os.getpid(),
+        config['TWILIO_ACCOUNT_SID'],
+        config['TWILIO_AUTH_TOKEN'],
+        config['TWILIO_VERIFY_SERVICE_ID'],
+        config['TWILIO_VERIFY_BASE_URL'])
+    cached = _client
+    if cached is None or cached[0] != key:
+        with _client_lock:
+            if _client is None or _client[0] != key:
+                _client = (key, _build_twilio_verify_client(config))
+            cached = _client
+    return cached[1]
+
+
+# ==================== #
+# === Health checks === #
+# ==================== #
+
+class VerifyUnavailable(TwilioException):
+    """The Verify API has been failing; calls are refused until it recovers"""
+
+
+verify_breaker = CircuitBreaker(
+    'twilio-verify',
+    failure_rate=app.config['VERIFY_BREAKER_FAILURE_RATE'],
+    min_calls=app.config['VERIFY_BREAKER_MIN_CALLS'],
+    window=app.config['VERIFY_BREAKER_WINDOW'],
+    open_seconds=app.config['VERIFY_BREAKER_OPEN_SECONDS'])
+verify_latency = {
+    'verifications': LatencyHistogram(),
+    'verification_checks': LatencyHistogram()
+}
+
+
+def _call_verify(operation, **kwargs):
+    """
+    verify.<operation>.create(**kwargs), through the circuit breaker
+
+    Only server errors and network failures count against the API; a
+    4xx answer (say, a check for an expired code) shows it is healthy.
+    A network failure (connection refused, timeout) comes back as
+    VerifyUnavailable, like a call the breaker refused.
+    """
+    resource = getattr(_get_twilio_verify_client(), operation)
+    ticket = verify_breaker.allow()
+    if ticket is None:
+        raise VerifyUnavailable(f'Twilio Verify is unavailable, {operation} not sent')
+    started = perf_counter()
+    try:
+        result = resource.create(**kwargs)
+    except TwilioRestException as e:
+        verify_breaker.record(ticket, e.status < 500)
+        raise
+    except RequestException as e:
+        verify_breaker.record(ticket, False)
+        raise VerifyUnavailable(f'Twilio Verify is unreachable, {operation} not sent') from e
+    except Exception:
+        verify_breaker.record(ticket, False)
+        raise
+    finally:
+        verify_latency[operation].observe(perf_counter() - started)
+    verify_breaker.record(ticket, True)
+    return result
+
+
+def verify_status():
+    """Breaker state and call latencies in this process, for operators"""
+    return {
+        'pid': os.getpid(),
+        'breaker': verify_breaker.snapshot(),
+        'latency': {
+            operation: histogram.snapshot()
+            for operation, histogram in verify_latency.items()}
+    }
+
+
+# ================ #
+# === Backends === #
+# ================ #
+
+class VerifyBackend(ABC):
+    """
+    Sends one-time codes to a phone number or email address and checks
+    them. Pick one with VERIFY_BACKEND.
+    """
+
+    @abstractmethod
+    def request_token(self, to, channel):
+        """Send a code to `to` by `channel` ('sms', 'call' or 'email')"""
+
+    @abstractmethod
+    def check_token(self, to, token):
+        """Whether token is the code last sent to `to`"""
+
+
+class TwilioVerifyBackend(VerifyBackend):
+    """Codes sent and checked by the Twilio Verify API"""
+
+    def request_token(self, to, channel):
+        _call_verify('verifications', to=to, channel=channel)
+
+    def check_token(self, to, token):
+        try:
+            result = _call_verify('verification_checks', to=to, code=token)
+            return result.status == 'approved'
+        except TwilioException as e:
+            return False
+
+
+class LocalVerifyBackend(VerifyBackend):
     """
-    return Client(
-        current_app.config['TWILIO_ACCOUNT_SID'],
-        current_app.config['TWILIO_AUTH_TOKEN']
-    ).verify.services(current_app.config['TWILIO_VERIFY_SERVICE_ID'])
+    Time-based HMAC codes (RFC 4226 truncation of an HMAC-SHA256 over the
+    address and time step), emailed through the outbox
+
+    A code is checked by recomputing it, so a check is a local
+    computation with no network call. A code stays valid for the step it
+    was issued in plus VERIFY_CODE_WINDOW earlier steps.
+
+    The verification throttle's store remembers two things per address:
+    failed checks, and when a code was last accepted. After
+    VERIFY_MAX_CHECK_FAILURES failures inside a code's lifetime every
+    check fails until they age out, so a six-digit code cannot be
+    guessed in the time it is valid. The time of the last accepted code
+    is part of the HMAC, so accepting a code retires it, and every other
+    code sent before it, and the next request gets a fresh one. Both
+    have to be the same in every worker process, so this backend needs
+    VERIFY_THROTTLE_STORE='database'; the app refuses to start without it.
+    """
+
+    def request_token(self, to, channel):
+        if channel != 'email':
+            raise ValueError(f'The local verification backend cannot send by {channel}')
+        config = current_app.config
+        token = self.generate_token(to, self.counter())
+        minutes = config['VERIFY_CODE_STEP'] * (config['VERIFY_CODE_WINDOW'] + 1) // 60
+        send_email(
+            '[somaSOMA] Your verification code',
+            sender=config['MAIL_DEFAULT_SENDER'],
+            recipients=[to],
+            text_body=render_template(
+                'emails/verification_code.txt', token=token, minutes=minutes),
+            html_body=render_template(
+                'emails/verification_code.html', token=token, minutes=minutes))
+        db.session.commit()
+
+    def check_token(self, to, token):
+        config = current_app.config
+        token = (token or '').strip()
+        address = self.address(to)
+        now = time()
+        with throttle.lock:
+            store = throttle.get_store()
+            # The store keeps everything for the throttle period; only the
+            # failures within a code's lifetime count
+            failed = [at for at in store.recent(f'check-failed:{address}', self.kept(now))
+                      if at >= now - self.lifetime()]
+            if len(failed) >= config['VERIFY_MAX_CHECK_FAILURES']:
+                return False
+            counter = self.counter()
+            used = self.last_used(store, address)
+            matches = [
+                hmac.compare_digest(self.generate_token(to, counter - step, used), token)
+                for step in range(config['VERIFY_CODE_WINDOW'] + 1)]
+            if any(matches):
+                store.add(f'code-used:{address}', now)
+                return True
+            store.add(f'check-failed:{address}', now)
+            return False
+
+    def counter(self):
+        return int(time() // current_app.config['VERIFY_CODE_STEP'])
+
+    def lifetime(self):
+        """Seconds a code can stay valid"""
+        config = current_app.config
+        return config['VERIFY_CODE_STEP'] * (config['VERIFY_CODE_WINDOW'] + 1)
+
+    @staticmethod
+    def address(to):
+        return to.strip().lower()
+
+    @staticmethod
+    def kept(now):
+        """Oldest time the throttle store holds on to"""
+        return now - current_app.config['VERIFY_THROTTLE_PERIOD']
+
+    def last_used(self, store, address):
+        """When a code for address was last accepted, 0 if not lately"""
+        # A code issued before a use older than this has expired long since
+        used = store.recent(f'code-used:{address}', self.kept(time()))
+        return used[-1] if used else 0
+
+    def generate_token(self, to, counter, used=None):
+        config = current_app.config
+        address = self.address(to)
+        if used is None:
+            with throttle.lock:
+                used = self.last_used(throttle.get_store(), address)
+        message = f'verify:{address}:{counter}:{used!r}'.encode()
+        digest = hmac.new(
+            config['SECRET_KEY'].encode(), message, hashlib.sha256).digest()
+        offset = digest[-1] & 0x0f
+        value = int.from_bytes(digest[offset:offset + 4], 'big') & 0x7fffffff
+        return str(value % 10 ** config['VERIFY_CODE_DIGITS']).zfill(
+            config['VERIFY_CODE_DIGITS'])
+
+
+verification_backends = {
+    'twilio': TwilioVerifyBackend,
+    'local': LocalVerifyBackend
+}
+
+
+def _get_verification_backend():
+    """The backend named by VERIFY_BACKEND"""
+    name = current_app.config['VERIFY_BACKEND']
+    try:
+        return verification_backends[name]()
+    except KeyError:
+        raise ValueError(f'Unknown VERIFY_BACKEND {name!r}')
 
 
 # ============= #
@@ -20,23 +279,18 @@ def request_verification_token(phone):
     """
     Request a verification token
     """
-    verify = _get_twilio_verify_client()
+    verify = _get_verification_backend()
     try:
-        verify.verifications.create(to=phone, channel='sms')
+        verify.request_token(phone, 'sms')
     except TwilioException as e:
-        verify.verifications.create(to=phone, channel='call')
+        verify.request_token(phone, 'call')
 
 
 def check_verification_token(phone, token):
     """
     Verify token received by user
     """
-    verify = _get_twilio_verify_client()
-    try:
-        result = verify.verification_checks.create(to=phone, code=token)
-        return result.status == 'approved'
-    except TwilioException as e:
-        return False
+    return _get_verification_backend().check_token(phone, token)
 
 
 # ============== #
@@ -45,15 +299,9 @@ def check_verification_token(phone, token):
 
 def request_email_verification_token(email):
     """Generate a token to be sent to client email"""
-    verify = _get_twilio_verify_client()
-    verify.verifications.create(to=email, channel='email')
+    _get_verification_backend().request_token(email, 'email')
 
 
 def check_email_verification_token(email, token):
     """Client's token is verified"""
-    verify = _get_twilio_verify_client()
-    try:
-        result = verify.verification_checks.create(to=email, code=token)
-        return result.status == 'approved'
-    except TwilioException as e:
-        return False
+    return _get_verification_backend().check_token(email, token)
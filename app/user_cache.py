@@ -0,0 +1,174 @@
+"""
+Who is logged in, cheaply
+
+Every request needs the current user's id, role and active flag; few
+need the rest of their profile. load_user now reads just the columns
+in AuthIdentity.fields with a Core select, skipping the polymorphic
+join to the role tables, and hands Flask-Login a small __slots__
+AuthIdentity. The full Parent, Student, Teacher or Admin entity is only
+loaded if a view or template touches some other attribute.
+
+Flask-Login calls the loader once per request and keeps the result on
+`g`. Across requests UserCache keeps each identity for USER_CACHE_TTL
+seconds, for at most USER_CACHE_SIZE users, so a hit runs no query at
+all. Any flush that changes or deletes a user drops that user from the
+cache once the transaction commits, so a deactivation takes effect on
+the next request in this process; other processes notice within the
+TTL. USER_CACHE_TTL = 0 turns the cache off.
+
+Relationships need real entities: assign foreign keys from
+current_user.id (user_id=..., parent_id=...) rather than passing
+current_user itself.
+"""
+import threading
+from collections import OrderedDict
+from time import monotonic
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from app import app, db
+
+
+class AuthIdentity(object):
+    """
+    The logged-in user as Flask-Login sees it
+
+    Anything beyond `fields` is read from, and written to, the full
+    entity, which is loaded on first use.
+    """
+    __slots__ = ('id', 'type', 'active', 'username', '_entity')
+    fields = ('id', 'type', 'active', 'username')
+
+    def __init__(self, id, type, active, username):
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'type', type)
+        object.__setattr__(self, 'active', active)
+        object.__setattr__(self, 'username', username)
+        object.__setattr__(self, '_entity', None)
+
+    @property
+    def entity(self):
+        """The Parent, Student, Teacher or Admin behind this identity"""
+        if self._entity is None:
+            from app.models import User
+            object.__setattr__(self, '_entity', db.session.get(User, self.id))
+        return self._entity
+
+    def __getattr__(self, name):
+        # Only called for names that are not slots
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.entity, name)
+
+    def __setattr__(self, name, value):
+        if name in self.fields:
+            object.__setattr__(self, name, value)
+        setattr(self.entity, name, value)
+
+    # Flask-Login's UserMixin interface
+
+    @property
+    def is_active(self):
+        return self.active
+
+    @property
+    def is_authenticated(self):
+        return True
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        if isinstance(other, AuthIdentity) or hasattr(other, 'get_id'):
+            return self.get_id() == other.get_id()
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f'AuthIdentity: {self.username} | {self.type}'
+
+
+class UserCache(object):
+    """Process-wide TTL/LRU cache of login identities by user id"""
+
+    def __init__(self, model):
+        self.model = model
+        # Table columns rather than mapped attributes: the mapper would
+        # join every role table to load its polymorphic subclasses
+        self.table = model.__table__
+        self.columns = [self.table.c[field] for field in AuthIdentity.fields]
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        event.listen(Session, 'after_flush', self.after_flush)
+        event.listen(Session, 'after_commit', self.after_commit)
+        event.listen(Session, 'after_soft_rollback', self.after_soft_rollback)
+        event.listen(Session, 'after_bulk_update', self.after_bulk)
+        event.listen(Session, 'after_bulk_delete', self.after_bulk)
+
+    def load(self, id):
+        """AuthIdentity for this user id, or None if there is no such user"""
+        ttl = app.config['USER_CACHE_TTL']
+        now = monotonic()
+        if ttl:
+            with self.lock:
+                entry = self.entries.get(id)
+                if entry is not None and entry[0] > now:
+                    self.entries.move_to_end(id)
+                    self.hits += 1
+                    return AuthIdentity(*entry[1])
+                self.misses += 1
+        row = db.session.execute(
+            select(*self.columns).where(self.table.c.id == id)).first()
+        if row is None:
+            return None
+        if ttl:
+            self.store(id, tuple(row), now + ttl)
+        return AuthIdentity(*row)
+
+    def store(self, id, row, expires_at):
+        with self.lock:
+            self.entries[id] = (expires_at, row)
+            self.entries.move_to_end(id)
+            while len(self.entries) > app.config['USER_CACHE_SIZE']:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *ids):
+        with self.lock:
+            for id in ids:
+                self.entries.pop(id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # Invalidation. Changed users are dropped as soon as they are flushed
+    # and again once committed, so a request that read the old row in
+    # between cannot leave it behind in the cache.
+
+    def after_flush(self, session, flush_context):
+        ids = {obj.id for obj in list(session.dirty) + list(session.deleted)
+               if isinstance(obj, self.model)}
+        if ids:
+            session.info.setdefault('changed_users', set()).update(ids)
+            self.invalidate(*ids)
+
+    def after_commit(self, session):
+        self.invalidate(*session.info.pop('changed_users', ()))
+
+    def after_soft_rollback(self, session, previous_transaction):
+        session.info.pop('changed_users', None)
+
+    def after_bulk(self, update_context):
+        if issubclass(update_context.mapper.class_, self.model):
+            self.clear()
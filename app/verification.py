@@ -0,0 +1,94 @@
+"""
+Sending verification tokens off the request path
+
+A sign-up should not wait on the Verify API. The view hands the request
+to a small pool of threads and redirects straight away; the outcome is
+kept by dispatch id so the verification page can tell the subscriber a
+code is still on its way, or that it could not be sent.
+
+Outcomes live in the process that sent them. Behind several gunicorn
+workers a later request may land elsewhere and simply not know about the
+dispatch, in which case the page behaves as it always has.
+"""
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+from app import app
+from app.twilio_verify_api import request_email_verification_token
+
+
+class VerificationDispatcher(object):
+    """
+    Run verification requests on `workers` threads
+
+    At most `workers + queue_size` requests are in flight; past that
+    submit() refuses work rather than letting the backlog grow.
+    """
+
+    def __init__(self, workers=None, queue_size=None, keep=None):
+        self.workers = workers or app.config['VERIFY_DISPATCH_WORKERS']
+        self.queue_size = app.config['VERIFY_DISPATCH_QUEUE'] if queue_size is None \
+            else queue_size
+        self.keep = keep or app.config['VERIFY_DISPATCH_KEEP']
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.slots = None
+        self.executor = None
+        self.pid = None
+
+    def pool(self):
+        """The executor for this process, started on first use"""
+        with self.lock:
+            if self.pid != os.getpid():
+                # Threads do not survive a fork; start over in the child
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='verify')
+                self.slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+                self.results.clear()
+                self.pid = os.getpid()
+            return self.executor
+
+    def submit(self, address, request=request_email_verification_token, on_failure=None):
+        """
+        Queue request(address); return a dispatch id, or None if the queue
+        is full. on_failure() is called, on the sending thread, if the
+        request raises.
+        """
+        executor = self.pool()
+        if not self.slots.acquire(blocking=False):
+            app.logger.warning(f'Verification queue full, not sending to {address}')
+            return None
+        dispatch_id = uuid4().hex
+        self.record(dispatch_id, 'sending')
+        future = executor.submit(self.run, dispatch_id, address, request, on_failure)
+        future.add_done_callback(lambda future: self.slots.release())
+        return dispatch_id
+
+    def run(self, dispatch_id, address, request, on_failure=None):
+        with app.app_context():
+            try:
+                request(address)
+            except Exception as e:
+                app.logger.error(f'Verification token not sent to {address}: {e}')
+                if on_failure is not None:
+                    on_failure()
+                self.record(dispatch_id, 'failed')
+            else:
+                self.record(dispatch_id, 'sent')
+
+    def record(self, dispatch_id, status):
+        with self.lock:
+            self.results[dispatch_id] = status
+            self.results.move_to_end(dispatch_id)
+            while len(self.results) > self.keep:
+                self.results.popitem(last=False)
+
+    def status(self, dispatch_id):
+        """'sending', 'sent', 'failed', or None if this process never saw it"""
+        with self.lock:
+            return self.results.get(dispatch_id)
+
+
+dispatcher = VerificationDispatcher()
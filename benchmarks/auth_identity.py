@@ -0,0 +1,88 @@
+"""
+Cost of loading the logged-in user per request
+
+Compares the full polymorphic entity load (the old user loader) with the
+narrow AuthIdentity select, uncached and through the user cache. Each
+"request" starts a fresh session and reads what every page reads:
+is_active, type and username. Runs against a scratch in-memory database.
+
+    (venv)$ python -m benchmarks.auth_identity --users 400 --rounds 20
+"""
+import os
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+import argparse
+import tracemalloc
+from time import perf_counter
+from app import app, db
+from app.models import User, Parent, Student, Teacher, Admin, user_cache
+
+
+def add_users(count):
+    roles = (Parent, Student, Teacher, Admin)
+    db.session.add_all([
+        roles[i % len(roles)](username=f'user{i}', email=f'user{i}@email.com')
+        for i in range(count)])
+    db.session.commit()
+    return [id for id, in db.session.query(User.id)]
+
+
+def entity(id):
+    return db.session.get(User, id)
+
+
+def identity(id):
+    return user_cache.load(id)
+
+
+def per_request(load, ids, rounds):
+    """Mean seconds to load one user and read the auth fields"""
+    start = perf_counter()
+    for i in range(rounds):
+        for id in ids:
+            db.session.remove()
+            user = load(id)
+            user.is_active, user.type, user.username
+    db.session.remove()
+    return (perf_counter() - start) / (rounds * len(ids))
+
+
+def retained(load, ids):
+    """Bytes held per loaded user while a request is in flight"""
+    db.session.remove()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    users = [load(id) for id in ids]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del users
+    db.session.remove()
+    return (after - before) / len(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=400)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        ids = add_users(args.users)
+        app.config['USER_CACHE_TTL'] = 0
+        results = [('full entity', entity), ('identity', identity)]
+        rows = [(label, per_request(load, ids, args.rounds), retained(load, ids))
+                for label, load in results]
+        app.config['USER_CACHE_TTL'] = 3600
+        user_cache.clear()
+        per_request(identity, ids, 1)
+        rows.append(('cached identity', per_request(identity, ids, args.rounds),
+                     retained(identity, ids)))
+
+    for label, seconds, size in rows:
+        print(f'{label:>16}: {seconds * 1e6:7.1f}us per request, '
+              f'{size / 1024:5.1f}KiB per loaded user')
+
+
+if __name__ == '__main__':
+    main()
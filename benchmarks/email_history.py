@@ -0,0 +1,73 @@
+"""
+Response time of the email history pages
+
+Fills a scratch SQLite database with stored emails spread over the
+individual-email kinds, then times whole requests (query, count and
+template) for the first page, a page in the middle and the last page of
+the teacher email history.
+
+    (venv)$ python -m benchmarks.email_history --emails 1000000 --rounds 20
+"""
+import os
+import tempfile
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'emails.db')
+
+import argparse
+import statistics
+from datetime import datetime, timedelta
+from time import perf_counter
+from app import app, db
+from app.models import Admin, Email
+
+KINDS = ('Teacher Email', 'Parent Email', 'Student Email', 'Admin Email',
+         'Newsletter Subscriber')
+
+
+def add_emails(count, author_id):
+    start = datetime(2020, 1, 1)
+    for first in range(0, count, 50000):
+        db.session.execute(Email.__table__.insert(), [{
+            'subject': f'Subject {i}', 'body': 'Hello there', 'closing': 'Regards',
+            'signature': 'somaSOMA', 'bulk': KINDS[i % len(KINDS)],
+            'timestamp': start + timedelta(seconds=i), 'allow': i % 2 == 0,
+            'user_id': author_id} for i in range(first, min(first + 50000, count))])
+    db.session.commit()
+
+
+def timed(client, page, rounds):
+    """Median and worst seconds for one page of the teacher email history"""
+    samples = []
+    for i in range(rounds):
+        start = perf_counter()
+        response = client.get(f'/dashboard/emails-to-individual-teachers?page={page}')
+        samples.append(perf_counter() - start)
+        assert response.status_code == 200
+    return statistics.median(samples), max(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--emails', type=int, default=1000000)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        admin = Admin(username='admin', email='admin@email.com')
+        db.session.add(admin)
+        db.session.commit()
+        add_emails(args.emails, admin.id)
+        admin_id = admin.id
+        last = -(-args.emails // len(KINDS) // app.config['EMAILS_PER_PAGE'])
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(admin_id)
+    print(f'{args.emails} stored emails, {last} pages of teacher emails')
+    for page in (1, last // 2 or 1, last):
+        median, worst = timed(client, page, args.rounds)
+        print(f'page {page:>6}: {median * 1e3:6.1f}ms median, {worst * 1e3:6.1f}ms worst')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Memory and speed of the streaming exports
+
+Fills a scratch SQLite database with students, then streams the students
+export to /dev/null in each format, reporting rows per second and the
+peak Python memory held while it ran. The peak should not grow with the
+number of rows.
+
+    (venv)$ python -m benchmarks.export --rows 1000000
+"""
+import os
+import tempfile
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'export.db')
+
+import argparse
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+from app import app, db
+from app.models import User, Student
+from app.exports import stream_export
+
+
+def add_students(count):
+    user = User.__table__
+    student = Student.__table__
+    for first in range(1, count + 1, 50000):
+        ids = range(first, min(first + 50000, count + 1))
+        db.session.execute(user.insert(), [{
+            'id': i, 'first_name': 'Student', 'last_name': str(i), 'username': f'student{i}',
+            'email': f'student{i}@email.com', 'active': True,
+            'registered_at': datetime(2023, 1, 1), 'type': 'student'} for i in ids])
+        db.session.execute(student.insert(), [{'id': i, 'school': 'Lean Sigma'} for i in ids])
+    db.session.commit()
+
+
+def measure(format, compress):
+    tracemalloc.start()
+    start = perf_counter()
+    written = 0
+    with open(os.devnull, 'wb') as f:
+        for chunk in stream_export('students', format, compress):
+            f.write(chunk)
+            written += len(chunk)
+    seconds = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        add_students(args.rows)
+        for format, compress in (('csv', False), ('csv', True), ('jsonl', False)):
+            seconds, peak, written = measure(format, compress)
+            label = format + (' gzip' if compress else '')
+            print(f'{label:>10}: {args.rows / seconds:9.0f} rows/s, '
+                  f'{written / 2 ** 20:7.1f}MiB written, peak {peak / 2 ** 20:5.1f}MiB held')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Per-recipient cost of rendering a newsletter
+
+Compares two Jinja renders per subscriber (the old path) against one
+render per campaign plus NewsletterRender.personalize().
+
+    (venv)$ python -m benchmarks.newsletter_render --recipients 10000 --issue 1
+"""
+import argparse
+from time import perf_counter
+from app import app
+from app.newsletter import NewsletterRender
+from app.models import Newsletter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--recipients', type=int, default=10000)
+    parser.add_argument('--issue', type=int, default=1)
+    args = parser.parse_args()
+
+    with app.test_request_context():
+        newsletter = Newsletter.query.filter_by(sequence=args.issue).first()
+        if newsletter is None:
+            parser.error(f'Newsletter {args.issue} is not in the catalog')
+        recipients = [
+            (f'Client{i}', f'client{i}@email.com') for i in range(args.recipients)]
+
+        start = perf_counter()
+        render = NewsletterRender(newsletter)
+        for client_username, client_email in recipients:
+            render.render(client_username, client_email)
+        full = perf_counter() - start
+
+        start = perf_counter()
+        render = NewsletterRender(newsletter)
+        for client_username, client_email in recipients:
+            render.personalize(client_username, client_email)
+        cached = perf_counter() - start
+
+    print(f'Newsletter {newsletter.sequence}: {newsletter.template}')
+    if render.fallback:
+        print('Template transforms personal fields; personalize() falls back to full renders')
+    for label, elapsed in (('full render', full), ('campaign cache', cached)):
+        print(f'{label:>15}: {elapsed:.3f}s total, '
+              f'{elapsed / args.recipients * 1e6:.1f}us per recipient')
+    print(f'{"speed-up":>15}: {full / cached:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
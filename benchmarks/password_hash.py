@@ -0,0 +1,55 @@
+"""
+Login latency under a burst for different password hash costs
+
+Fires --logins password checks from --concurrency threads at once, the
+way a burst of logins reaches the app, through the bounded hashing pool.
+Prints p50/p99 latency per PBKDF2 iteration count so PASSWORD_HASH_METHOD
+can be set to the highest cost that still meets --budget-ms.
+
+    (venv)$ python -m benchmarks.password_hash --iterations 100000 260000 600000
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from werkzeug.security import generate_password_hash
+from app import app
+from app.dispatch import percentile
+from app.passwords import PasswordHasher
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, nargs='+', default=[100000, 260000, 600000])
+    parser.add_argument('--logins', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--workers', type=int, help='Hashing threads (default PASSWORD_HASH_WORKERS)')
+    parser.add_argument('--budget-ms', type=float, default=250)
+    args = parser.parse_args()
+
+    with app.app_context():
+        hasher = PasswordHasher(workers=args.workers, queue_size=args.concurrency)
+        print(f'{args.logins} logins from {args.concurrency} threads, '
+              f'{hasher.workers} hashing threads')
+        for iterations in args.iterations:
+            pwhash = generate_password_hash('somaSOMA123', f'pbkdf2:sha256:{iterations}')
+
+            def login(i):
+                started = perf_counter()
+                hasher.check(pwhash, 'somaSOMA123')
+                return perf_counter() - started
+
+            start = perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as burst:
+                latencies = list(burst.map(login, range(args.logins)))
+            elapsed = perf_counter() - start
+            p99 = percentile(latencies, 99) * 1000
+            verdict = 'within' if p99 <= args.budget_ms else 'over'
+            print(f'pbkdf2:sha256:{iterations:<8} '
+                  f'p50 {percentile(latencies, 50) * 1000:7.1f}ms  '
+                  f'p99 {p99:7.1f}ms  '
+                  f'{args.logins / elapsed:6.1f} logins/second  '
+                  f'({verdict} the {args.budget_ms:.0f}ms budget)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Rows per second of a student roster import
+
+Fills a roster CSV with --rows students and imports it into a scratch
+SQLite database, then registers --one-by-one more students the way
+register_student() does, each with its own uniqueness queries, hash,
+commit and queued email, for comparison. Passwords are hashed with the
+configured PASSWORD_HASH_METHOD.
+
+    (venv)$ python -m benchmarks.roster_import --rows 2000 --workers 1 4
+"""
+import os
+import tempfile
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'roster.db')
+
+import argparse
+import csv
+import io
+from time import perf_counter
+from app import app, db
+from app.email import send_login_details
+from app.models import User, Student
+from app.roster import RosterImport, COLUMNS
+
+
+def roster(prefix, count):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, COLUMNS)
+    writer.writeheader()
+    for i in range(count):
+        writer.writerow({
+            'first_name': 'Student', 'last_name': str(i), 'username': f'{prefix}{i}',
+            'email': f'{prefix}{i}@email.com', 'phone_number': '+254700111222',
+            'password': f'somaSOMA{i}', 'age': '12', 'school': 'Lean Sigma',
+            'coding_experience': 'No experience', 'program': 'Python',
+            'program_schedule': 'Once A Week', 'cohort': 'Learning Group 1'})
+    buffer.seek(0)
+    return buffer
+
+
+def one_by_one(count):
+    start = perf_counter()
+    for i in range(count):
+        username, email = f'single{i}', f'single{i}@email.com'
+        assert User.query.filter_by(username=username).first() is None
+        assert User.query.filter_by(email=email).first() is None
+        student = Student(first_name='Student', last_name=str(i), username=username,
+                          email=email, phone_number='+254700111222', age=12,
+                          school='Lean Sigma', program='Python')
+        student.set_password(f'somaSOMA{i}')
+        db.session.add(student)
+        db.session.commit()
+        send_login_details(student, f'somaSOMA{i}')
+    return count / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count()])
+    parser.add_argument('--one-by-one', type=int, default=100)
+    args = parser.parse_args()
+
+    with app.app_context(), app.test_request_context():
+        db.create_all()
+        print(f'{app.config["PASSWORD_HASH_METHOD"]}, {args.rows} rows per roster')
+        for run_number, workers in enumerate(args.workers):
+            run = RosterImport(workers=workers)
+            assert run.run(roster(f'roster{run_number}_', args.rows)), run.errors
+            timings = ', '.join(f'{phase} {seconds:.2f}s'
+                                for phase, seconds in run.timings.items())
+            print(f'{workers:>3} hashing processes: {run.rate:7.0f} rows/s ({timings})')
+        if args.one_by_one:
+            print(f'          one at a time: {one_by_one(args.one_by_one):7.0f} rows/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Per-verification cost of building the Twilio Verify client
+
+Compares a new client (and connection) per verification, the old path,
+against the shared pooled client. Runs against the local Verify
+stand-in unless --base-url points somewhere else.
+
+    (venv)$ python -m benchmarks.verify_client --verifications 200
+"""
+import argparse
+from time import perf_counter
+from app import app
+from app import twilio_verify_api
+from verify_stand_in import VerifyStandIn
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--verifications', type=int, default=200)
+    parser.add_argument('--base-url', help='Verify API to call instead of the stand-in')
+    args = parser.parse_args()
+
+    server = None
+    if args.base_url is None:
+        server = VerifyStandIn().start()
+        app.config.update(
+            TWILIO_ACCOUNT_SID='ACbenchmark',
+            TWILIO_AUTH_TOKEN='token',
+            TWILIO_VERIFY_SERVICE_ID='VAbenchmark')
+    app.config['TWILIO_VERIFY_BASE_URL'] = args.base_url or server.url
+
+    with app.app_context():
+        start = perf_counter()
+        for i in range(args.verifications):
+            verify = twilio_verify_api._build_twilio_verify_client(app.config)
+            verify.verifications.create(to=f'client{i}@email.com', channel='email')
+        fresh = perf_counter() - start
+
+        start = perf_counter()
+        for i in range(args.verifications):
+            twilio_verify_api.request_email_verification_token(f'client{i}@email.com')
+        pooled = perf_counter() - start
+
+    if server is not None:
+        print(f'Stand-in saw {server.connections} connections for '
+              f'{2 * args.verifications} verifications')
+        server.stop()
+    for label, elapsed in (('new client', fresh), ('pooled client', pooled)):
+        print(f'{label:>15}: {elapsed:.3f}s total, '
+              f'{elapsed / args.verifications * 1000:.2f}ms per verification')
+    print(f'{"saved":>15}: {(fresh - pooled) / args.verifications * 1000:.2f}ms per verification')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,47 @@ class Config(object):
     # Web form security
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-cannot-guess'
 
+    # Password hashing
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:260000'
+    PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 16)
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 0) # 0: one per CPU
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 64)
+    PASSWORD_HASH_WAIT = float(os.environ.get('PASSWORD_HASH_WAIT') or 10) # seconds
+
+    # Logged-in user cache
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 10) # seconds, 0 = off
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 1024)
+
+    # Dashboard totals
+    ROLE_STATS_TTL = int(os.environ.get('ROLE_STATS_TTL') or 60) # seconds, 0 = off
+    ROLE_STATS_STAMP = os.environ.get('ROLE_STATS_STAMP') or \
+        os.path.join(basedir, 'role_stats.stamp') # touched to drop every process's totals
+
+    # Email history
+    EMAILS_PER_PAGE = int(os.environ.get('EMAILS_PER_PAGE') or 20)
+
+    # Avatars
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR') or \
+        os.path.join(basedir, 'avatars')
+    AVATAR_CACHE_BYTES = int(os.environ.get('AVATAR_CACHE_BYTES') or 64 * 1024 * 1024)
+    AVATAR_MAX_SIZE = int(os.environ.get('AVATAR_MAX_SIZE') or 512) # pixels
+    AVATAR_MAX_AGE = int(os.environ.get('AVATAR_MAX_AGE') or 365 * 24 * 3600) # seconds
+
+    # User search
+    SEARCH_RESULTS_PER_PAGE = int(os.environ.get('SEARCH_RESULTS_PER_PAGE') or 20)
+
+    # Exports
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE') or 1000) # rows read at a time
+
+    # Student roster imports
+    ROSTER_HASH_WORKERS = int(os.environ.get('ROSTER_HASH_WORKERS') or 0) # processes, 0: one per CPU
+    ROSTER_BATCH_SIZE = int(os.environ.get('ROSTER_BATCH_SIZE') or 500) # rows per INSERT
+    ROSTER_WORKER_POLL_INTERVAL = float(os.environ.get('ROSTER_WORKER_POLL_INTERVAL') or 5) # seconds
+
+    # User listings
+    USERS_PAGE_SIZE = int(os.environ.get('USERS_PAGE_SIZE') or 25)
+    USERS_PAGE_MAX = int(os.environ.get('USERS_PAGE_MAX') or 100)
+
     # Database configurations
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
@@ -21,12 +62,56 @@ class Config(object):
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('SENDGRID_API_KEY')
     MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER')
+    MAIL_MAX_EMAILS = int(os.environ.get('MAIL_MAX_EMAILS') or 100) # per SMTP connection
     ADMINS = ['ADMINS']
 
+    # Newsletters
+    NEWSLETTER_BATCH_SIZE = int(os.environ.get('NEWSLETTER_BATCH_SIZE') or 500)
+    NEWSLETTER_PROGRESS_BATCH = int(os.environ.get('NEWSLETTER_PROGRESS_BATCH') or 100)
+    NEWSLETTER_WORKERS = int(os.environ.get('NEWSLETTER_WORKERS') or 1)
+
+    # Mail provider limits
+    MAIL_MAX_CONNECTIONS = int(os.environ.get('MAIL_MAX_CONNECTIONS') or 4)
+    MAIL_RATE_LIMIT = float(os.environ.get('MAIL_RATE_LIMIT') or 0) # messages/second, 0 = no limit
+
+    # Mail worker (flask mail-worker)
+    MAIL_WORKER_BATCH_SIZE = int(os.environ.get('MAIL_WORKER_BATCH_SIZE') or 20)
+    MAIL_WORKER_POLL_INTERVAL = float(os.environ.get('MAIL_WORKER_POLL_INTERVAL') or 2)
+    MAIL_WORKER_MAX_ATTEMPTS = int(os.environ.get('MAIL_WORKER_MAX_ATTEMPTS') or 5)
+    MAIL_WORKER_LEASE = int(os.environ.get('MAIL_WORKER_LEASE') or 300) # seconds
+    MAIL_WORKER_RETRY_DELAY = int(os.environ.get('MAIL_WORKER_RETRY_DELAY') or 60) # seconds, doubled per failure
+
+    # Verification codes: 'twilio' (Verify API) or 'local' (HMAC codes sent by email)
+    VERIFY_BACKEND = os.environ.get('VERIFY_BACKEND') or 'twilio' # or 'local', with VERIFY_THROTTLE_STORE='database'
+    VERIFY_CODE_DIGITS = int(os.environ.get('VERIFY_CODE_DIGITS') or 6)
+    VERIFY_CODE_STEP = int(os.environ.get('VERIFY_CODE_STEP') or 300) # seconds
+    VERIFY_CODE_WINDOW = int(os.environ.get('VERIFY_CODE_WINDOW') or 1) # earlier steps accepted
+    VERIFY_MAX_CHECK_FAILURES = int(os.environ.get('VERIFY_MAX_CHECK_FAILURES') or 5) # per code lifetime
+
+    # Verification code throttling
+    VERIFY_THROTTLE_STORE = os.environ.get('VERIFY_THROTTLE_STORE') or 'memory' # or 'database'
+    VERIFY_DEDUPE_WINDOW = int(os.environ.get('VERIFY_DEDUPE_WINDOW') or 60) # seconds
+    VERIFY_THROTTLE_PERIOD = int(os.environ.get('VERIFY_THROTTLE_PERIOD') or 3600) # seconds
+    VERIFY_MAX_PER_ADDRESS = int(os.environ.get('VERIFY_MAX_PER_ADDRESS') or 5)
+    VERIFY_MAX_PER_IP = int(os.environ.get('VERIFY_MAX_PER_IP') or 20)
+    VERIFY_THROTTLE_MAX_KEYS = int(os.environ.get('VERIFY_THROTTLE_MAX_KEYS') or 10000)
+
     # Twilio Verify
     TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
     TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
     TWILIO_VERIFY_SERVICE_ID = os.environ.get('TWILIO_VERIFY_SERVICE_ID')
+    TWILIO_VERIFY_BASE_URL = os.environ.get('TWILIO_VERIFY_BASE_URL') # None: https://verify.twilio.com
+    TWILIO_CONNECT_TIMEOUT = float(os.environ.get('TWILIO_CONNECT_TIMEOUT') or 3)
+    TWILIO_READ_TIMEOUT = float(os.environ.get('TWILIO_READ_TIMEOUT') or 10)
+    TWILIO_HTTP_POOL_SIZE = int(os.environ.get('TWILIO_HTTP_POOL_SIZE') or 10)
+    VERIFY_BREAKER_FAILURE_RATE = float(os.environ.get('VERIFY_BREAKER_FAILURE_RATE') or 0.5)
+    VERIFY_BREAKER_MIN_CALLS = int(os.environ.get('VERIFY_BREAKER_MIN_CALLS') or 5)
+    VERIFY_BREAKER_WINDOW = int(os.environ.get('VERIFY_BREAKER_WINDOW') or 20) # recent calls
+    VERIFY_BREAKER_OPEN_SECONDS = float(os.environ.get('VERIFY_BREAKER_OPEN_SECONDS') or 30)
+    VERIFY_DISPATCH_WORKERS = int(os.environ.get('VERIFY_DISPATCH_WORKERS') or 4)
+    VERIFY_DISPATCH_QUEUE = int(os.environ.get('VERIFY_DISPATCH_QUEUE') or 100)
+    VERIFY_DISPATCH_KEEP = int(os.environ.get('VERIFY_DISPATCH_KEEP') or 10000) # outcomes remembered
 
     # Deployment
-    LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
\ No newline at end of file
+    LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR') or 0) # proxies setting X-Forwarded-For
\ No newline at end of file
@@ -1,7 +1,7 @@
 from app import app, db
 from app import cli
-from app.models import User, Parent, Student, Teacher, Admin, Newsletter_Subscriber,\
-    Email, Chapter2Quiz, Chapter3Quiz, Chapter4Quiz
+from app.models import User, Parent, Student, Teacher, Admin, Newsletter, Newsletter_Subscriber,\
+    Email, Chapter2Quiz, Chapter3Quiz, Chapter4Quiz, Outbox
 
 
 cli.register(app)
@@ -16,9 +16,11 @@ def make_shell_context():
         Teacher=Teacher,
         Parent=Parent,
         Student=Student,
+        Newsletter=Newsletter,
         Newsletter_Subscriber=Newsletter_Subscriber,
         Email=Email,
         Chapter2Quiz=Chapter2Quiz,
         Chapter3Quiz=Chapter3Quiz,
-        Chapter4Quiz=Chapter4Quiz
+        Chapter4Quiz=Chapter4Quiz,
+        Outbox=Outbox
         )
@@ -0,0 +1,54 @@
+"""user search index
+
+Revision ID: 383e280559c2
+Revises: 8fd53c78b66b
+Create Date: 2026-10-18 09:04:50.583942
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '383e280559c2'
+down_revision = '8fd53c78b66b'
+branch_labels = None
+depends_on = None
+
+
+# Full-text index of the user directory, see app/search.py
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE user_search USING fts5("
+            "type UNINDEXED, name, username, email, details, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')")
+        op.execute(
+            "INSERT INTO user_search (rowid, type, name, username, email, details) "
+            "SELECT u.id, u.type, coalesce(u.first_name, '') || ' ' || coalesce(u.last_name, ''), "
+            "u.username, u.email, "
+            "coalesce(s.school, '') || ' ' || coalesce(s.program, '') || ' ' || "
+            "coalesce(s.cohort, '') "
+            'FROM "user" u LEFT OUTER JOIN student s ON s.id = u.id')
+    elif dialect == 'postgresql':
+        op.execute(
+            'CREATE TABLE user_search ('
+            'id INTEGER PRIMARY KEY REFERENCES "user" (id) ON DELETE CASCADE, '
+            'type VARCHAR(64), document TSVECTOR NOT NULL)')
+        op.execute(
+            'CREATE INDEX ix_user_search_document ON user_search USING GIN (document)')
+        op.execute(
+            "INSERT INTO user_search (id, type, document) "
+            "SELECT u.id, u.type, "
+            "setweight(to_tsvector('simple', regexp_replace(concat_ws(' ', "
+            "u.first_name, u.last_name, u.username), '\\W+', ' ', 'g')), 'A') || "
+            "setweight(to_tsvector('simple', regexp_replace(u.email, '\\W+', ' ', 'g')), 'B') || "
+            "setweight(to_tsvector('simple', regexp_replace(concat_ws(' ', "
+            "s.school, s.program, s.cohort), '\\W+', ' ', 'g')), 'C') "
+            'FROM "user" u LEFT OUTER JOIN student s ON s.id = u.id')
+
+
+def downgrade():
+    if op.get_bind().dialect.name in ('sqlite', 'postgresql'):
+        op.execute('DROP TABLE user_search')
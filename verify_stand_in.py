@@ -0,0 +1,94 @@
+"""
+Local stand-in for the Twilio Verify API
+
+Answers the two endpoints the app uses, over HTTP/1.1 keep-alive, so
+tests and benchmarks can point TWILIO_VERIFY_BASE_URL at it instead of
+https://verify.twilio.com.
+
+    server = VerifyStandIn(latency=0.2).start()
+    app.config['TWILIO_VERIFY_BASE_URL'] = server.url
+"""
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class VerifyStandIn(object):
+    """Verify API stand-in; every code other than `code` is rejected"""
+
+    def __init__(self, code='123456', latency=0.0, fail=False):
+        self.code = code
+        self.latency = latency
+        self.fail = fail
+        self.requests = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                # Headers and body go out in separate writes; don't let
+                # Nagle hold the body back on a kept-alive connection
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with stand_in.lock:
+                    stand_in.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                form = {key: values[0] for key, values in
+                        parse_qs(self.rfile.read(length).decode()).items()}
+                with stand_in.lock:
+                    stand_in.requests.append((self.path, form))
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+                if stand_in.fail:
+                    return self.reply(503, {'code': 20503, 'message': 'Service unavailable',
+                                            'status': 503})
+                if self.path.endswith('/VerificationCheck'):
+                    approved = form.get('Code') == stand_in.code
+                    return self.reply(200, {
+                        'sid': 'VEstandin', 'to': form.get('To'),
+                        'status': 'approved' if approved else 'pending',
+                        'valid': approved})
+                if self.path.endswith('/Verifications'):
+                    return self.reply(201, {
+                        'sid': 'VEstandin', 'to': form.get('To'),
+                        'channel': form.get('Channel'), 'status': 'pending'})
+                self.reply(404, {'code': 20404, 'message': 'Not found', 'status': 404})
+
+            def reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler